@@ -0,0 +1,237 @@
+import os
+import sys
+import numpy as np
+from galaxy import Galaxy
+import kernel
+import metrics
+from tree import expansion, hderiv
+import config
+
+G = config.G
+eps = config.eps
+THETA = config.THETA
+BITS = config.BITS
+BACKEND = config.BACKEND
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# ------------------------------
+# Backends: one force evaluation + one integration step each
+# ------------------------------
+class Backend:
+    name = None
+
+    def accel(self, gx, active=None):
+        # active: mask of the particles whose acceleration is needed
+        raise NotImplementedError
+
+    def warm_up(self, gx):
+        kernel.warm_up(gx, self.accel)
+
+    def update(self, gx):
+        kernel.update(gx, self.accel)
+
+
+class Python(Backend):
+    # the original pair loop, kept as the reference the others are checked against
+    name = "python"
+
+    def accel(self, gx, active=None):
+        N = gx.N
+        pos = gx.pos.tolist()
+        m = gx.masses.tolist()
+        acc = [[0.0, 0.0] for _ in range(N)]
+
+        for i in range(N):
+            for j in range(i+1, N):
+                dx = pos[j][0] - pos[i][0]
+                dy = pos[j][1] - pos[i][1]
+                dist = (dx*dx + dy*dy)**0.5 + eps
+                inv = G / (dist*dist*dist)
+
+                acc[i][0] += m[j] * dx * inv
+                acc[i][1] += m[j] * dy * inv
+                acc[j][0] -= m[i] * dx * inv
+                acc[j][1] -= m[i] * dy * inv
+
+        return np.array(acc, dtype=np.float32)
+
+
+class NumPy(Backend):
+    # vectorized Barnes–Hut (or whichever config.SOLVER selects)
+    name = "numpy"
+
+    def accel(self, gx, active=None, theta=THETA):
+        return kernel.accel(gx, active, theta)
+
+
+class Numba(Backend):
+    # the same quadtree and expansions, walked leaf bucket by leaf bucket
+    # in compiled parallel loops
+    name = "numba"
+
+    def accel(self, gx, active=None, theta=THETA):
+        if kernel.SOLVER != "tree" or gx.pool is not None:
+            # FMM / PM / TreePM and the worker pool stay with kernel.accel
+            return kernel.accel(gx, active, theta)
+        order, tree = kernel.retree(gx)
+        at = slice(None) if order is None else order
+
+        leaves = tree.leaves
+        if active is not None:
+            leaves = leaves[np.add.reduceat(active[at], tree.start[leaves]) > 0]
+
+        # far-field coefficients as in Quadtree.expand, flattened for the jit
+        keys, mix = expansion(tree.order)
+        Q = tree.Q if tree.order >= 2 else tree.M[:,None].astype(np.complex128)
+        C = G * (Q @ mix)
+        H = [hderiv(n) for n in range(tree.order + 1)]
+        hn = np.array([n for n, h in enumerate(H) for _ in h])
+        hc, ha, hb = np.array([t for h in H for t in h]).T
+        ha, hb = ha.astype(np.int64), hb.astype(np.int64)
+
+        t = metrics.clock()
+        acc = np.zeros((gx.N, 2), dtype=np.float32)
+        acc[at] = jit_walk(tree.pos, tree.mass, tree.start, tree.end, tree.nchild, tree.child,
+                              tree.size, tree.M, tree.com, leaves, theta,
+                              C, np.array(keys), hn, hc, ha, hb)
+        metrics.lap("force", t)
+        return acc
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def jit_walk(pos, mass, start, end, nchild, child, size, M, com, leaves, theta,
+                 C, keys, hn, hc, ha, hb):
+        N = len(pos)
+        acc = np.zeros((N, 2), dtype=np.float32)
+        t2 = theta * theta
+        order = hn[-1]
+
+        for g in numba.prange(len(leaves)):
+            s, e = start[leaves[g]], end[leaves[g]]
+            lox, loy = pos[s,0], pos[s,1]
+            hix, hiy = lox, loy
+            for i in range(s+1, e):
+                lox, hix = min(lox, pos[i,0]), max(hix, pos[i,0])
+                loy, hiy = min(loy, pos[i,1]), max(hiy, pos[i,1])
+            gx, gy = 0.5*(lox + hix), 0.5*(loy + hiy)
+            hx, hy = 0.5*(hix - lox), 0.5*(hiy - loy)
+
+            Hn = np.zeros(order+1)
+            ir = np.ones(ha.max()+1)
+            ie = np.ones(hb.max()+1)
+            dp = np.empty(order+2, dtype=np.complex128)
+            dc = np.empty(order+2, dtype=np.complex128)
+            stack = np.empty(4*(BITS+2), dtype=np.int64)
+            stack[0] = 0
+            top = 1
+            while top:
+                top -= 1
+                n = stack[top]
+                if M[n] <= 0:
+                    continue
+
+                dx = max(abs(com[n,0] - gx) - hx, 0.0)
+                dy = max(abs(com[n,1] - gy) - hy, 0.0)
+                if size[n]*size[n] < t2 * (dx*dx + dy*dy):
+                    for i in range(s, e):
+                        d = complex(com[n,0] - pos[i,0], com[n,1] - pos[i,1])
+                        r = abs(d)
+                        for k in range(1, len(ir)):
+                            ir[k] = ir[k-1] / r
+                        for k in range(1, len(ie)):
+                            ie[k] = ie[k-1] / (r + eps)
+                        Hn[:] = 0.0
+                        for h in range(len(hn)):
+                            Hn[hn[h]] += hc[h] * ir[ha[h]] * ie[hb[h]]
+                        dp[0], dc[0] = 1.0, 1.0
+                        for p in range(1, order+2):
+                            dp[p] = dp[p-1] * d
+                            dc[p] = dc[p-1] * d.conjugate()
+                        f = 0j
+                        for u in range(len(keys)):
+                            f += C[n,u] * dp[keys[u,0]] * dc[keys[u,1]] * Hn[keys[u,2]]
+                        acc[i,0] += f.real
+                        acc[i,1] += f.imag
+                elif nchild[n] == 0:
+                    for i in range(s, e):
+                        for j in range(start[n], end[n]):
+                            rx, ry = pos[j,0] - pos[i,0], pos[j,1] - pos[i,1]
+                            dist = np.sqrt(rx*rx + ry*ry) + eps
+                            w = G * mass[j] / (dist*dist*dist)
+                            acc[i,0] += w * rx
+                            acc[i,1] += w * ry
+                else:
+                    for c in range(nchild[n]):
+                        stack[top] = child[n] + c
+                        top += 1
+        return acc
+
+
+BACKENDS = {"python": Python, "numpy": NumPy}
+if numba is not None:
+    BACKENDS["numba"] = Numba
+
+FASTEST = ["numba", "numpy"]
+TOL = 0.05     # relative rms error a tree backend may show against the pair loop
+PERIODIC = ["pm", "treepm"]     # solvers checked against the minimum-image direct sum
+
+
+# ------------------------------
+# Selection: --backend NAME, then $GRAVITY_BACKEND, then config.BACKEND
+# ------------------------------
+def select(name=None, argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for i, arg in enumerate(argv):
+        if arg.startswith("--backend="):
+            name = name or arg.split("=", 1)[1]
+        elif arg == "--backend" and i+1 < len(argv):
+            name = name or argv[i+1]
+    name = name or os.environ.get("GRAVITY_BACKEND") or BACKEND
+
+    if name == "auto" and kernel.SOLVER in PERIODIC:
+        # every backend but the pair loop hands these solvers to kernel.accel,
+        # whose accuracy is the mesh's (see config.RS), not the backend's
+        name = next(n for n in FASTEST if n in BACKENDS)
+    if name == "auto":
+        errors = check([n for n in FASTEST if n in BACKENDS], verbose=False)
+        name = next((n for n in errors if errors[n] < TOL), None)
+        if name is None:
+            # never the O(N^2) pair loop behind the user's back
+            print("backend: no backend passed the self-check ("
+                  + ", ".join(f"{n} rel. error {errors[n]:.2e}" for n in errors)
+                  + f", tolerance {TOL}), using numpy")
+            name = "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r}, available: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+def check(names=None, N=256, seed=0, verbose=True):
+    # relative rms deviation of every backend from the pair loop on one fixed
+    # galaxy, or from the minimum-image direct sum for the periodic solvers
+    gx = Galaxy(N)
+    gx.rando(seed)
+
+    if kernel.SOLVER in PERIODIC:
+        ref = kernel.direct(gx.pos, gx.masses, periodic=True).astype(np.float64)
+    else:
+        ref = Python().accel(gx).astype(np.float64)
+    errors = {}
+    for name in names or BACKENDS:
+        a = BACKENDS[name]().accel(gx)
+        errors[name] = float(np.linalg.norm(a - ref) / np.linalg.norm(ref))
+        if verbose:
+            status = "ok" if errors[name] < TOL else "FAIL"
+            print(f"{name:8s} rel. error {errors[name]:.2e}  {status}")
+    return errors
+
+
+
+if __name__ == "__main__":
+    check()
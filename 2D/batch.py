@@ -0,0 +1,128 @@
+import argparse
+import os
+import time
+from galaxy import Galaxy
+import backends
+from parallel import Pool
+from trajectory import Writer
+import checkpoint
+import metrics
+import diagnostics
+import config
+
+# ------------------------------
+# Headless batch runner, the notebook driver without a window:
+#
+#   python -m batch --n 100000 --steps 5000 --ic rando --backend numba \
+#                   --out run.traj --every 10
+#
+# Frames go to a trajectory file as they are made (replay it with
+# playa.py), progress is one line per --report steps on stdout. With
+# --checkpoint PREFIX the state is saved every --checkpoint-every steps
+# in the background, and --resume carries on from the newest one up to
+# --steps in total, appending to --out after the frames recorded before
+# that checkpoint (the rest is recorded again). --diagnostics FILE
+# samples energy, momentum and the virial ratio every --diag-every steps
+# into a .npy time series (see diagnostics.py).
+# ------------------------------
+ICS = ["rando", "big_bang", "plummer", "disk", "collision"]
+
+
+def parse(argv=None):
+    p = argparse.ArgumentParser(prog="python -m batch", description="run a 2D simulation without a window")
+    p.add_argument("--n", type=int, default=100, help="particles")
+    p.add_argument("--steps", type=int, default=1000)
+    p.add_argument("--ic", choices=ICS, default="rando", help="initial conditions")
+    p.add_argument("--center", type=float, default=3.0, help="mass added at the origin (0: none)")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--backend", default=config.BACKEND, help="python, numpy, numba or auto")
+    p.add_argument("--workers", type=int, default=config.WORKERS)
+    p.add_argument("--out", default="history.traj", help="trajectory file")
+    p.add_argument("--every", type=int, default=1, help="steps between recorded frames")
+    p.add_argument("--tol", type=float, default=config.TRAJ_TOL,
+                   help="max recorded position error in units of L (0: raw float32)")
+    p.add_argument("--report", type=int, default=100, help="steps between progress lines")
+    p.add_argument("--profile", action="store_true", default=config.PROFILE,
+                   help="add the per-phase step profile to every progress line")
+    p.add_argument("--checkpoint", default=None, help="checkpoint file prefix")
+    p.add_argument("--checkpoint-every", type=int, default=1000)
+    p.add_argument("--resume", action="store_true", help="start from the newest checkpoint")
+    p.add_argument("--diagnostics", default=None, help="energy / momentum time series (.npy)")
+    p.add_argument("--diag-every", type=int, default=config.DIAG_EVERY or 10)
+    return p.parse_args(argv)
+
+
+def run(args):
+    metrics.enable(args.profile)
+    diagnostics.enable(args.diag_every if args.diagnostics else 0)
+    backend = backends.select(args.backend, argv=[])
+
+    path = checkpoint.latest(args.checkpoint) if args.resume and args.checkpoint else None
+    if path is not None:
+        gx = checkpoint.restore(path)
+        print(f"resuming from {path}")
+    else:
+        gx = Galaxy(args.n)
+        getattr(gx, args.ic)(seed=args.seed)
+        if args.center:
+            gx.add(args.center, (0,0), (0,0))
+    if args.workers != 1:
+        Pool(gx, args.workers)
+    if gx.acc is None:
+        backend.warm_up(gx)     # checkpoints carry their accelerations
+    print(f"backend: {backend.name}, N={gx.N}, steps {gx.steps}..{args.steps} -> {args.out}", flush=True)
+
+    if path is not None and os.path.exists(args.out):
+        # frames of the steps before the checkpoint: 0, every, 2 every, ...
+        recorded = -(-gx.steps // args.every)
+        writer = Writer.reopen(args.out, recorded)
+        if writer.frames + len(writer.pending) < recorded:
+            print(f"{args.out} holds {writer.frames + len(writer.pending)} of the {recorded} frames "
+                  f"before step {gx.steps}, appending after them", flush=True)
+    else:
+        writer = Writer(args.out, gx.by_id(gx.masses), tol=args.tol)
+    saver = checkpoint.Checkpointer(args.checkpoint) if args.checkpoint else None
+    start = t_report = time.perf_counter()
+    reported = gx.steps
+    try:
+        if gx.steps % args.every == 0 or writer.frames + len(writer.pending) == 0:
+            writer.append(gx.by_id(gx.pos), gx.by_id(gx.masses))
+        revision = gx.revision
+        for step in range(gx.steps + 1, args.steps + 1):
+            backend.update(gx)
+            if step % args.every == 0:
+                # masses only when merges or removals may have changed them
+                masses = gx.by_id(gx.masses) if gx.revision != revision else None
+                writer.append(gx.by_id(gx.pos), masses)
+                revision = gx.revision
+            if saver is not None and step % args.checkpoint_every == 0:
+                writer.flush()      # every frame before a checkpoint is on disk to resume after
+                saver.save(gx)
+
+            if step % args.report == 0 or step == args.steps:
+                now = time.perf_counter()
+                rate = (step - reported) / (now - t_report)
+                eta = (args.steps - step) / rate
+                print(f"step {step}/{args.steps}  {rate:.2f} steps/s  frames {writer.frames + len(writer.pending)}  "
+                      f"elapsed {now - start:.1f} s  eta {eta:.1f} s", flush=True)
+                if metrics.enabled:
+                    print(f"  {metrics.line()}", flush=True)
+                if diagnostics.every:
+                    print(f"  {diagnostics.line()}", flush=True)
+                reported, t_report = step, now
+    finally:
+        writer.close()
+        if saver is not None:
+            saver.close()
+        if gx.pool is not None:
+            gx.pool.close()
+        if args.diagnostics:
+            diagnostics.save(args.diagnostics)
+    print(f"tree rebuilds {gx.rebuilds}, refits {gx.refits}")
+    if saver is not None:
+        print(f"checkpoints {saver.written}, stepping stalled {saver.stall*1e3:.1f} ms on a full queue")
+
+
+
+if __name__ == "__main__":
+    run(parse())
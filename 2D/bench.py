@@ -0,0 +1,196 @@
+import argparse
+import datetime
+import functools
+import json
+import os
+import resource
+import subprocess
+import time
+import numpy as np
+from galaxy import Galaxy
+import backends
+import kernel
+from parallel import Pool
+
+# ------------------------------
+# Benchmarks: every force engine over a sweep of N, opening angle and
+# initial conditions, one JSON record per run appended to --out
+#
+#   python bench.py --n 1000 10000 100000 --theta 0.5 0.8 --compare old.jsonl
+#   python bench.py --engines numpy --n 100000 --workers 1 2 4 8 16
+#
+# --workers runs the tree engines on the shared-memory worker pool
+# (parallel.py) with each count in turn and prints the speed-up over the
+# first count.
+#
+# steps_per_s   full kernel.update steps, after one warm-up step
+# mem_peak_mb   peak resident memory above the start of the run
+# force_error   relative rms force error against the exact direct sum
+#               (minimum image for the periodic pm / treepm), on SAMPLE
+#               random particles of the initial conditions
+# ------------------------------
+DIM = 2
+TREES = ["numpy", "numba"]              # engines taking an opening angle
+SOLVERS = ["fmm", "pm", "treepm"]       # kernel.SOLVER alternatives, run on the numpy backend
+LIMIT = {"python": 2000, "direct": 20000}   # largest N worth running the O(N^2) engines at
+SAMPLE = 2048
+ICS = ["rando", "big_bang", "plummer", "disk", "collision"]
+SLOWDOWN = 0.10     # --compare flags runs this much slower or less accurate
+
+
+def engines():
+    return ["direct"] + list(backends.BACKENDS) + SOLVERS
+
+
+def force(name, theta):
+    if name == "direct":
+        return lambda gx, active=None: kernel.direct(gx.pos, gx.masses)
+    if name in SOLVERS:
+        return backends.NumPy().accel
+    b = backends.BACKENDS[name]()
+    return functools.partial(b.accel, theta=theta) if name in TREES else b.accel
+
+
+def run(name, N, theta, ic, steps, seed, workers=1):
+    solver = kernel.SOLVER
+    if name in SOLVERS:
+        kernel.SOLVER = name
+    gx = None
+    try:
+        base = peak_reset()
+        gx = Galaxy(N)
+        getattr(gx, ic)(seed=seed)
+        if workers != 1:
+            Pool(gx, workers)
+        f = force(name, theta)
+
+        sample = np.random.default_rng(seed).choice(N, min(SAMPLE, N), replace=False)
+        ref = kernel.direct(gx.pos, gx.masses, targets=sample,
+                            periodic=name in backends.PERIODIC).astype(np.float64)
+        a = f(gx)[sample]
+        error = float(np.linalg.norm(a - ref) / np.linalg.norm(ref))
+
+        kernel.update(gx, f)     # warm-up: jit, first tree, block-step bins
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            kernel.update(gx, f)
+        rate = steps / (time.perf_counter() - t0)
+        mem = (peak_rss() - base) / 2**20
+    finally:
+        kernel.SOLVER = solver
+        if gx is not None and gx.pool is not None:
+            gx.pool.close()
+
+    return dict(dim=DIM, engine=name, N=N, theta=theta if name in TREES else None, ic=ic, seed=seed,
+                workers=workers, steps=steps, steps_per_s=rate, mem_peak_mb=mem, force_error=error)
+
+
+# ------------------------------
+# Peak resident memory: /proc/self/clear_refs resets VmHWM on Linux,
+# elsewhere the high-water mark is the process lifetime's
+# ------------------------------
+def peak_reset():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def key(r):
+    return r["dim"], r["engine"], r["N"], r["theta"], r["ic"], r["seed"], r.get("workers", 1)
+
+
+def scaling(records):
+    # speed-up of every worker count over the first one run
+    runs = {}
+    for r in records:
+        runs.setdefault(key(r)[:-1], []).append(r)
+    for (_, name, N, theta, ic, _), rs in runs.items():
+        if len(rs) < 2:
+            continue
+        base = rs[0]["steps_per_s"]
+        steps = "  ".join(f"{r['workers']}: x{r['steps_per_s'] / base:.2f}" for r in rs)
+        print(f"{name:8s} N={N:<8d} theta={theta}  {ic:9s} workers {steps}")
+
+
+def compare(records, path):
+    # latest earlier record for every configuration run now
+    old = {}
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            old[key(r)] = r
+    for r in records:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        speed = r["steps_per_s"] / o["steps_per_s"]
+        worse = speed < 1 - SLOWDOWN or r["force_error"] > o["force_error"] * (1 + SLOWDOWN) + 1e-7
+        print(f"{r['engine']:8s} N={r['N']:<8d} theta={r['theta']}  {r['ic']:9s} workers={r.get('workers', 1)} "
+              f"speed x{speed:.2f}  error {o['force_error']:.2e} -> {r['force_error']:.2e}"
+              f"{'  REGRESSION' if worse else ''}")
+
+
+def parse(argv=None):
+    p = argparse.ArgumentParser(description=f"benchmark the {DIM}D force engines")
+    p.add_argument("--n", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--theta", type=float, nargs="+", default=[0.5, 0.8])
+    p.add_argument("--ic", nargs="+", choices=ICS, default=["rando", "big_bang"])
+    p.add_argument("--engines", nargs="+", choices=engines(), default=engines())
+    p.add_argument("--workers", type=int, nargs="+", default=[1],
+                   help="worker pool sizes for the tree engines (1: in-process, 0: all cores)")
+    p.add_argument("--steps", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", default="bench.jsonl")
+    p.add_argument("--compare", default=None, help="earlier results to compare against")
+    return p.parse_args(argv)
+
+
+def main(args):
+    meta = dict(revision=revision(), numpy=np.__version__, cpus=os.cpu_count(),
+                date=datetime.datetime.now().isoformat(timespec="seconds"))
+    records = []
+    for N in args.n:
+        for name in args.engines:
+            if N > LIMIT.get(name, N):
+                print(f"{name:8s} N={N:<8d} skipped, above {LIMIT[name]}")
+                continue
+            for theta in (args.theta if name in TREES else [None]):
+                for ic in args.ic:
+                    for workers in (args.workers if name in TREES else [1]):
+                        r = dict(run(name, N, theta, ic, args.steps, args.seed, workers), **meta)
+                        records.append(r)
+                        print(f"{name:8s} N={N:<8d} theta={theta}  {ic:9s} workers={workers:<3d}"
+                              f"{r['steps_per_s']:9.3f} steps/s  {r['mem_peak_mb']:8.1f} MB  "
+                              f"error {r['force_error']:.2e}", flush=True)
+                        with open(args.out, "a") as f:
+                            f.write(json.dumps(r) + "\n")
+    scaling(records)
+    if args.compare:
+        compare(records, args.compare)
+
+
+
+if __name__ == "__main__":
+    main(parse())
@@ -0,0 +1,112 @@
+import glob
+import os
+import queue
+import threading
+import time
+import numpy as np
+from galaxy import Galaxy
+import config
+
+CHECKPOINT_QUEUE = config.CHECKPOINT_QUEUE
+CHECKPOINT_KEEP = config.CHECKPOINT_KEEP
+
+
+# ------------------------------
+# Checkpoints: <prefix>.<step>.npz holding everything needed to carry on
+# stepping (state in particle id order with the retired ids marked, the
+# block-step bins and cached accelerations and the step counter).
+#
+# The stepping thread only copies the state into a bounded queue; a
+# background thread writes it to <file>.tmp, fsyncs and renames it over
+# the final name, so a crash leaves either the old file or the new one.
+# Time spent waiting on a full queue is counted in Checkpointer.stall.
+# ------------------------------
+class Checkpointer(threading.Thread):
+    def __init__(self, prefix, depth=CHECKPOINT_QUEUE, keep=CHECKPOINT_KEEP):
+        # keep: newest checkpoints left on disk (0: all)
+        super().__init__(daemon=True)
+        self.prefix = prefix
+        self.keep = keep
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.stall = 0.0
+        self.written = 0
+        self.start()
+
+
+    def save(self, gx):
+        if self.error is not None:
+            raise self.error
+        state = snapshot(gx)
+        t0 = time.perf_counter()
+        self.queue.put(state)
+        self.stall += time.perf_counter() - t0
+
+
+    def run(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                return
+            try:
+                write(f"{self.prefix}.{state['steps']:010d}.npz", state)
+                self.written += 1
+                if self.keep:
+                    for old in checkpoints(self.prefix)[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+
+def snapshot(gx):
+    # copies, so the galaxy can keep stepping while this is written
+    alive = np.zeros(gx.capacity, dtype=bool)
+    alive[gx.ids[gx.alive]] = True
+    return dict(alive=alive,
+        pos=gx.by_id(gx.pos), vel=gx.by_id(gx.vel), masses=gx.by_id(gx.masses),
+        bin=gx.by_id(gx.bin), acc=gx.by_id(gx.acc) if gx.acc is not None else np.zeros(0),
+        steps=gx.steps,
+    )
+
+
+def write(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def checkpoints(prefix):
+    # oldest first
+    return sorted(glob.glob(glob.escape(prefix) + ".*.npz"))
+
+
+def latest(prefix):
+    found = checkpoints(prefix)
+    return found[-1] if found else None
+
+
+def restore(path):
+    # a fresh Galaxy (storage in id order) as it was when the checkpoint
+    # was taken
+    with np.load(path) as f:
+        gx = Galaxy(len(f["masses"]))
+        gx.pos[:] = f["pos"]
+        gx.vel[:] = f["vel"]
+        gx.masses[:] = f["masses"]
+        gx.bin[:] = f["bin"]
+        if len(f["acc"]):
+            gx.acc = f["acc"].copy()
+        gx.steps = int(f["steps"])
+        gx.remove(~f["alive"])
+    return gx
@@ -7,4 +7,44 @@ eps = 2
 e = 0.7
 L = 100
 BITS = 7
-GRID = 1 << BITS
\ No newline at end of file
+GRID = 1 << BITS
+THETA = 0.8
+ORDER = 2       # tree expansion order: 0 monopole, 2 quadrupole .. 4 hexadecapole
+LEAF = 16
+TILE = 1024
+CHUNK = 1 << 20
+SOLVER = "tree"  # "tree" (Barnes–Hut), "fmm", "pm" or "treepm"
+FMM_ORDER = 6
+FMM_LEAF = 16
+KMAX = 0            # deepest block timestep bin, dt = deltaT / 2^k for k <= KMAX (0: one global step, one force evaluation)
+ETA = 0.1           # timestep accuracy, dt = ETA sqrt(eps / |a|)
+DRIFT = 0.5         # refit the tree until a particle drifts this many grid cells, then rebuild
+SORT_EVERY = 8      # permute the Galaxy arrays into Morton order every k steps (0: never)
+INTERPOLATE = True  # draw positions blended between the last two simulation states
+RECORD = None       # trajectory file to append every simulated frame to, e.g. "run.traj"
+TRAJ_TOL = 1e-4     # max recorded position error, in units of L (0: raw float32 frames)
+KEYFRAME = 32       # frames per compressed block, the random-access granularity
+CHECKPOINT_QUEUE = 2   # checkpoints that may wait for the disk before stepping stalls
+CHECKPOINT_KEEP = 3    # newest checkpoints kept on disk (0: all)
+PROFILE = False     # time every phase of a step and count interactions (P toggles it in the viewer)
+PROFILE_WINDOW = 60 # steps the rolling profile summary averages over
+BACKEND = "auto"    # "python", "numpy", "numba" or "auto" (fastest that passes the self-check)
+SEED = None         # initial-condition seed (None: fresh entropy every run)
+COLLIDE = False     # particles closer than RADIUS (sqrt(m_i) + sqrt(m_j)) merge or bounce
+RADIUS = 0.125      # contact radius per sqrt(mass)
+MERGE_RATIO = 3.0   # a partner this many times heavier swallows the other, else they bounce with restitution e
+COMPACT = 0.25      # dead fraction of the particle slots that triggers compaction
+DIAG_EVERY = 0      # energy / momentum / virial sample every k steps (0: off)
+WORKERS = 1         # tree force processes sharing the particle arrays (1: in-process, 0: all cores)
+
+# PM / TreePM accuracy, relative rms force error against the minimum-image
+# direct sum at N = 1e4 (bench.py's force_error for the initial conditions):
+#   treepm   ~0.5% on rando / plummer / disk, ~1.3% on a uniform box
+#            (99th percentile ~17%, particles whose net force nearly cancels)
+#   pm       ~1.5-4% on rando / plummer / disk, ~25% on a uniform box, whose
+#            force comes from structure below a few mesh cells
+# The TreePM error is the mesh's share and falls as RS grows (2 cells:
+# 5% on the uniform box), at the cost of a longer short-range walk.
+RS = 4.0 * (2*L / GRID)    # TreePM split scale
+RCUT = 5.0                 # short-range cut-off, in units of RS
+THETA_SR = 0.3             # opening angle of the short-range tree walk (0.5: ~4% on the uniform box)
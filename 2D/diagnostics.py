@@ -0,0 +1,74 @@
+import numpy as np
+import config
+
+deltaT = config.deltaT
+THETA = config.THETA
+DIAG_EVERY = config.DIAG_EVERY
+
+# ------------------------------
+# Conservation diagnostics every DIAG_EVERY steps, one row per sample in
+# `series`:
+#
+#   step, time      gx.steps and steps * deltaT
+#   kinetic         sum m v^2 / 2
+#   potential       sum m phi / 2, phi from a walk of the step's own tree
+#   energy          kinetic + potential
+#   px, py          linear momentum
+#   lz              angular momentum about the origin (jumps when a
+#                   particle wraps around the periodic box)
+#   virial          2 kinetic / |potential|
+#
+# The potential walk costs about one force evaluation, so k steps apart
+# it adds roughly 1/k of a step. table() returns the series as a
+# structured array, save() writes it with np.save.
+# ------------------------------
+FIELDS = [("step", np.int64), ("time", np.float64), ("kinetic", np.float64), ("potential", np.float64),
+          ("energy", np.float64), ("px", np.float64), ("py", np.float64), ("lz", np.float64),
+          ("virial", np.float64)]
+
+every = DIAG_EVERY
+series = []
+
+
+def enable(k=DIAG_EVERY):
+    global every
+    every = k
+    series.clear()
+
+
+def due(gx):
+    return every > 0 and gx.steps % every == 0
+
+
+def record(gx, order, tree, theta=THETA):
+    # order / tree: the step's tree over gx (kernel.retree), order None
+    # while gx storage is itself in tree order
+    m = gx.masses.astype(np.float64)
+    v = gx.vel.astype(np.float64)
+    x = gx.pos.astype(np.float64)
+    kinetic = 0.5 * (m * (v*v).sum(axis=1)).sum()
+    potential = 0.5 * (tree.mass * tree.potential(theta)).sum()
+    p = m @ v
+    lz = (m * (x[:,0]*v[:,1] - x[:,1]*v[:,0])).sum()
+    virial = 2 * kinetic / abs(potential) if potential else np.inf
+
+    row = (gx.steps, gx.steps * deltaT, kinetic, potential, kinetic + potential, p[0], p[1], lz, virial)
+    series.append(row)
+    return dict(zip(table().dtype.names, row))
+
+
+def table():
+    return np.array(series, dtype=FIELDS)
+
+
+def save(path):
+    np.save(path, table())
+
+
+def line():
+    if not series:
+        return "diagnostics: none yet"
+    t = table()
+    e0, e = t["energy"][0], t["energy"][-1]
+    return (f"E {e:.6g} (drift {(e - e0) / abs(e0):+.2e})  virial {t['virial'][-1]:.3f}  "
+            f"p ({t['px'][-1]:.3g}, {t['py'][-1]:.3g})  lz {t['lz'][-1]:.6g}")
@@ -0,0 +1,257 @@
+import numpy as np
+from math import comb, factorial
+import config
+from tree import hderiv, morton2D, ramp
+
+G = config.G
+eps = config.eps
+L = config.L
+CHUNK = config.CHUNK
+FMM_ORDER = config.FMM_ORDER
+FMM_LEAF = config.FMM_LEAF
+
+# relative cell offsets of the M2L interaction list: children of the
+# parent's neighbours that are not neighbours themselves
+OFFSETS = [(dx, dy) for dx in range(-3, 4) for dy in range(-3, 4) if max(abs(dx), abs(dy)) >= 2]
+NEAR = [(dx, dy) for dx in range(-1, 2) for dy in range(-1, 2)]
+
+
+# ------------------------------
+# Expansions
+#
+# Multipoles M_kl = sum m w^k conj(w)^l about a cell centre, locals
+# a(z) = G sum L_ij z^i conj(z)^j about a cell centre, both for k+l <= p.
+# The softened law is not harmonic, so both carry every (k, l) pair and
+# M2L is the Wirtinger Taylor series of u H(u conj(u)) at the centre
+# separation, H(rho) = (sqrt(rho) + eps)^-3.
+# ------------------------------
+def terms(p):
+    return [(k, n-k) for n in range(p+1) for k in range(n+1)]
+
+
+def kderiv(a, b, D, H):
+    # d^a/du^a d^b/dv^b [u H(uv)] at u = D, v = conj(D)
+    r = abs(D)
+    total = 0j
+    for j in range(min(a, b+1) + 1):
+        h = sum(c * r**-i * (r + eps)**-k for c, i, k in H[a+b-j])
+        total += comb(a, j) * factorial(b+1) / factorial(b+1-j) * D**(b+1-j) * np.conj(D)**(a-j) * h
+    return total
+
+
+class Operators:
+    # translation matrices for one expansion order, cached per level/offset;
+    # expansions are row vectors so a translation is M @ A
+    def __init__(self, p):
+        self.p = p
+        self.T = terms(p)
+        self.H = [hderiv(n) for n in range(2*p + 1)]
+        self.cache = {}
+
+        k, l = np.array(self.T).T
+        self.KI = k[:,None] + k[None,:]
+        self.LJ = l[:,None] + l[None,:]
+        f = np.array([factorial(a) for a in range(p+1)], dtype=float)
+        self.COEF = (-1.0)**(k+l)[None,:] / (f[k]*f[l])[:,None] / (f[k]*f[l])[None,:]
+
+
+    def m2l(self, D):
+        key = ('m2l', D)
+        if key not in self.cache:
+            n = 2*self.p + 1
+            K = np.zeros((n, n), dtype=np.complex128)
+            for a in range(n):
+                for b in range(n - a):
+                    K[a, b] = kderiv(a, b, D, self.H)
+            self.cache[key] = K[self.KI, self.LJ] * self.COEF
+        return self.cache[key]
+
+
+    def m2m(self, t):
+        # moments about a child centre -> parent centre, t = child - parent
+        key = ('m2m', t)
+        if key not in self.cache:
+            A = np.zeros((len(self.T), len(self.T)), dtype=np.complex128)
+            for u, (i, j) in enumerate(self.T):
+                for v, (k, l) in enumerate(self.T):
+                    if i <= k and j <= l:
+                        A[u, v] = comb(k, i) * comb(l, j) * t**(k-i) * np.conj(t)**(l-j)
+            self.cache[key] = A
+        return self.cache[key]
+
+
+    def l2l(self, t):
+        # local about a parent centre -> child centre, t = child - parent
+        key = ('l2l', t)
+        if key not in self.cache:
+            B = np.zeros((len(self.T), len(self.T)), dtype=np.complex128)
+            for u, (i, j) in enumerate(self.T):
+                for v, (a, b) in enumerate(self.T):
+                    if a <= i and b <= j:
+                        B[u, v] = comb(i, a) * comb(j, b) * t**(i-a) * np.conj(t)**(j-b)
+            self.cache[key] = B
+        return self.cache[key]
+
+
+OPERATORS = {}
+
+
+# ------------------------------
+# Solver
+# ------------------------------
+def accel(pos, mass, p=FMM_ORDER, leaf=FMM_LEAF):
+    N = len(pos)
+    if p not in OPERATORS:
+        OPERATORS[p] = Operators(p)
+    ops = OPERATORS[p]
+    T = ops.T
+
+    # ------------------------------
+    # 1. Morton order at a depth that keeps ~leaf particles per cell
+    # ------------------------------
+    depth = int(np.clip(np.ceil(np.log(max(N, 1) / leaf) / np.log(4)), 2, 16))
+    side = 1 << depth
+    # positions wrap into the periodic box first: a cell's expansions
+    # only hold for particles inside it (the minimum only guards rounding)
+    pos = (pos + L) % (2*L) - L
+    ix = np.minimum(((pos[:,0] + L) / (2*L) * side).astype(np.int64), side-1)
+    iy = np.minimum(((pos[:,1] + L) / (2*L) * side).astype(np.int64), side-1)
+
+    codes = morton2D(ix, iy)
+    order = np.argsort(codes)
+    codes, ix, iy = codes[order], ix[order], iy[order]
+    z = pos[order,0].astype(np.float64) + 1j*pos[order,1]
+    m = mass[order].astype(np.float64)
+
+    # occupied cells of every level: sorted keys, particle starts, coords
+    keys, starts, cx, cy = [], [], [], []
+    for level in range(depth+1):
+        key = codes >> (2*(depth-level))
+        s = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+        keys.append(key[s])
+        starts.append(s)
+        cx.append(ix[s] >> (depth-level))
+        cy.append(iy[s] >> (depth-level))
+
+    def centre(level):
+        h = 2*L / (1 << level)
+        return (-L + (cx[level] + 0.5)*h) + 1j*(-L + (cy[level] + 0.5)*h)
+
+    # ------------------------------
+    # 2. P2M on the leaf cells
+    # ------------------------------
+    s = starts[depth]
+    cnt = np.diff(np.append(s, N))
+    w = z - np.repeat(centre(depth), cnt)
+    wc = np.conj(w)
+
+    M = [None] * (depth+1)
+    M[depth] = np.stack([np.add.reduceat(m * w**k * wc**l, s) for k, l in T], axis=1)
+
+    # ------------------------------
+    # 3. M2M up to level 2
+    # ------------------------------
+    for level in range(depth-1, 1, -1):
+        h = 2*L / (1 << (level+1))
+        parent = np.searchsorted(keys[level], keys[level+1] >> 2)
+        quad = keys[level+1] & 3
+
+        shifted = np.empty_like(M[level+1])
+        for q in range(4):
+            sel = quad == q
+            t = complex((q & 1) - 0.5, (q >> 1) - 0.5) * h
+            shifted[sel] = M[level+1][sel] @ ops.m2m(t)
+
+        first = np.flatnonzero(np.diff(parent, prepend=-1))
+        M[level] = np.add.reduceat(shifted, first)
+
+    # ------------------------------
+    # 4. M2L per level, one matmul per relative offset
+    # ------------------------------
+    Lc = [np.zeros((len(k), len(T)), dtype=np.complex128) for k in keys]
+
+    for level in range(2, depth+1):
+        h = 2*L / (1 << level)
+        n = 1 << level
+        for dx, dy in OFFSETS:
+            sx, sy = cx[level] + dx, cy[level] + dy
+            ok = ((sx >= 0) & (sx < n) & (sy >= 0) & (sy < n)
+                  & (np.abs((sx >> 1) - (cx[level] >> 1)) <= 1)
+                  & (np.abs((sy >> 1) - (cy[level] >> 1)) <= 1))
+            tgt, src = find(keys[level], ok, sx, sy)
+            if len(tgt):
+                Lc[level][tgt] += M[level][src] @ ops.m2l(complex(dx, dy) * h)
+
+    # ------------------------------
+    # 5. L2L down to the leaves
+    # ------------------------------
+    for level in range(2, depth):
+        h = 2*L / (1 << (level+1))
+        parent = np.searchsorted(keys[level], keys[level+1] >> 2)
+        quad = keys[level+1] & 3
+
+        for q in range(4):
+            sel = np.flatnonzero(quad == q)
+            t = complex((q & 1) - 0.5, (q >> 1) - 0.5) * h
+            Lc[level+1][sel] += Lc[level][parent[sel]] @ ops.l2l(t)
+
+    # ------------------------------
+    # 6. L2P
+    # ------------------------------
+    cell = np.repeat(np.arange(len(s)), cnt)
+    a = np.zeros(N, dtype=np.complex128)
+    for u, (i, j) in enumerate(T):
+        a += Lc[depth][cell, u] * w**i * wc**j
+    a *= G
+
+    acc = np.stack([a.real, a.imag])
+
+    # ------------------------------
+    # 7. P2P with the neighbouring leaves
+    # ------------------------------
+    xy = np.stack([z.real, z.imag]).astype(np.float32)
+    for dx, dy in NEAR:
+        sx, sy = cx[depth] + dx, cy[depth] + dy
+        ok = (sx >= 0) & (sx < side) & (sy >= 0) & (sy < side)
+        tgt, src = find(keys[depth], ok, sx, sy)
+
+        c = cnt[src]
+        j = np.repeat(s[src], c) + ramp(c)
+        t = np.repeat(tgt, c)
+        p2p(acc, xy, s[t], cnt[t], j, m.astype(np.float32))
+
+    out = np.empty((N, 2), dtype=np.float32)
+    out[order] = acc.T
+    return out
+
+
+
+def find(keys, ok, sx, sy):
+    # targets with a valid occupied neighbour at (sx, sy), and its index
+    tgt = np.flatnonzero(ok)
+    skey = morton2D(sx[tgt], sy[tgt])
+    src = np.minimum(np.searchsorted(keys, skey), len(keys)-1)
+    hit = keys[src] == skey
+    return tgt[hit], src[hit]
+
+
+def p2p(acc, xy, ts, tn, j, m):
+    # source particle j[k] acts on targets ts[k] .. ts[k]+tn[k]-1
+    x, y = xy
+    total = np.cumsum(tn)
+    cut = np.searchsorted(total, np.arange(CHUNK, total[-1] if len(total) else 0, CHUNK))
+
+    for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+        if a == b:
+            continue
+        cnt = tn[a:b]
+        t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+        k = np.repeat(j[a:b], cnt)
+
+        dx = x[k] - x[t]
+        dy = y[k] - y[t]
+        dist = np.sqrt(dx*dx + dy*dy) + eps
+        w = G * m[k] / (dist*dist*dist)
+
+        acc[0] += np.bincount(t, weights=w*dx, minlength=acc.shape[1])
+        acc[1] += np.bincount(t, weights=w*dy, minlength=acc.shape[1])
@@ -1,5 +1,10 @@
 import numpy as np
 from galaxy import Galaxy
+from tree import Quadtree, morton2D, ramp
+import fmm
+import pm
+import metrics
+import diagnostics
 import config
 
 deltaT = config.deltaT
@@ -9,191 +14,407 @@ e = config.e
 L = config.L
 BITS = config.BITS
 GRID = config.GRID
-
-
-def update(gx):
-    N = gx.N
-    acc = np.zeros((N, 2), dtype=np.float32)
+THETA = config.THETA
+TILE = config.TILE
+SOLVER = config.SOLVER
+RS = config.RS
+THETA_SR = config.THETA_SR
+KMAX = config.KMAX
+ETA = config.ETA
+DRIFT = config.DRIFT
+SORT_EVERY = config.SORT_EVERY
+CHUNK = config.CHUNK
+COLLIDE = config.COLLIDE
+RADIUS = config.RADIUS
+MERGE_RATIO = config.MERGE_RATIO
+COLLIDE_ROUNDS = 4      # rounds of disjoint pairs resolved per step, the rest waits a step
+CELL_QUANTILE = 0.999   # radius quantile the collision cells are sized from
+
+
+def update(gx, force=None):
+    force = force or accel
+    start = metrics.clock()
+    if gx.acc is None:
+        warm_up(gx, force)
+    if KMAX and SOLVER == "tree":
+        # FMM, PM and TreePM solve the whole field whatever the targets, so
+        # they keep the global step's one evaluation
+        block_step(gx, force)
+    else:
+        # ------------------------------
+        # 5. Leapfrog integration, kick-drift-kick: the closing kick's
+        #    accelerations open the next step
+        # ------------------------------
+        t = metrics.clock()
+        gx.vel += 0.5 * gx.acc * deltaT     # retired slots have acc 0
+        drift(gx, deltaT)
+        t = metrics.lap("integrate", t)
+
+        # ------------------------------
+        # 6. Periodic boundaries
+        # ------------------------------
+        gx.pos[:,0] = (gx.pos[:,0] + L) % (2*L) - L
+        gx.pos[:,1] = (gx.pos[:,1] + L) % (2*L) - L
+        metrics.lap("wrap", t)
+
+        gx.acc = live_forces(gx, force)
+        t = metrics.clock()
+        gx.vel += 0.5 * gx.acc * deltaT
+        metrics.lap("integrate", t)
+
+    if COLLIDE:
+        t = metrics.clock()
+        collide(gx)
+        metrics.lap("collide", t)
 
     # ------------------------------
-    # 1. Morton ordering
+    # 7. Particle storage back into Morton order every SORT_EVERY steps
     # ------------------------------
-    ix = ((gx.pos[:,0] + L) / (2*L) * (GRID-1)).astype(np.uint32)
-    iy = ((gx.pos[:,1] + L) / (2*L) * (GRID-1)).astype(np.uint32)
+    gx.steps += 1
+    if SORT_EVERY and gx.steps % SORT_EVERY == 0 and gx.morton is not None:
+        t = metrics.clock()
+        gx.reorder(gx.morton)
+        metrics.lap("sort", t)
 
-    ix = np.clip(ix, 0, GRID-1)
-    iy = np.clip(iy, 0, GRID-1)
+    # conservation diagnostics every DIAG_EVERY steps, walking this
+    # step's tree (refit to the final positions) for the potential
+    if diagnostics.due(gx):
+        t = metrics.clock()
+        diagnostics.record(gx, *retree(gx))
+        metrics.lap("diagnostics", t)
+    metrics.finish(start)
 
-    codes = morton2D(ix, iy)
-    order = np.argsort(codes)
-    gx.morton = order
 
-    pos = gx.pos[order]
-    mass = gx.masses[order]
+    # print(np.max(np.linalg.norm(gx.pos, axis=1)))
 
-    # ------------------------------
-    # 2. Build implicit nodes (ranges)
-    # ------------------------------
-    nodes = [(0, N)]
-    for level in range(BITS):
-        new_nodes = []
-        mask = 1 << (2*(BITS-1-level))
 
-        for s, e in nodes:
-            if e - s <= 1:
-                new_nodes.append((s, e))
-                continue
 
-            split = s
-            for i in range(s+1, e):
-                if (codes[order[i]] & mask) != (codes[order[i-1]] & mask):
-                    new_nodes.append((split, i))
-                    split = i
-            new_nodes.append((split, e))
 
-        nodes = new_nodes
+def warm_up(gx, force=None):
+    # accelerations at the starting positions, for the opening kick of
+    # the first step, and the first block timestep bins
+    force = force or accel
+    gx.acc = live_forces(gx, force)
+    gx.bin[:] = np.where(gx.alive, timestep_bins(gx.acc), 0)
 
-    # ------------------------------
-    # 3. Compute node mass + COM
-    # ------------------------------
-    node_mass = []
-    node_com  = []
-
-    for s, e in nodes:
-        ids = slice(s, e)
-        m = mass[ids].sum()
-        if m > 0:
-            com = (pos[ids] * mass[ids,None]).sum(axis=0) / m
-        else:
-            com = np.zeros(2)
-        node_mass.append(m)
-        node_com.append(com)
 
-    # ------------------------------
-    # 4. Barnes–Hut force evaluation
-    # ------------------------------
-    theta = 0.5
-    box_size = 2 * L
 
-    for ii in range(N):
-        i = order[ii]
-        pi = gx.pos[i]
-        ai = np.zeros(2)
+def live_forces(gx, force):
+    # every live particle's acceleration; retired slots are no targets
+    # and read 0, so kicks leave them at rest
+    if gx.count == gx.N:
+        return force(gx)
+    acc = force(gx, active=gx.alive)
+    acc[~gx.alive] = 0
+    return acc
 
-        for (s,e), m, com in zip(nodes, node_mass, node_com):
-            if m == 0:
-                continue
 
-            size = box_size * (e - s) / N
-            d = com - pi
-            dist = np.linalg.norm(d) + eps
 
-            if (size / dist) < theta or (e - s) == 1:
-                ai += G * m * d / (dist**3)
+def drift(gx, dt):
+    # retired slots stay where they were retired
+    if gx.count == gx.N:
+        gx.pos += gx.vel * dt
+    else:
+        np.add(gx.pos, gx.vel * dt, out=gx.pos, where=gx.alive[:,None])
 
-        acc[i] = ai
 
+
+def block_step(gx, force):
     # ------------------------------
-    # 5. Leapfrog integration
+    # 5. Block timesteps: bin k kicks with dt = deltaT / 2^k, everyone
+    #    drifts together and only the particles closing a step get new
+    #    forces (targets of the active bin, sources from the full tree);
+    #    retired slots sit in bin 0 and are never kicked or targeted
     # ------------------------------
-    gx.vel += 0.5 * acc * deltaT
-    gx.pos += gx.vel * deltaT
-    gx.vel += 0.5 * acc * deltaT
+    ticks = 1 << KMAX
+    h = deltaT / ticks
+    n = 0
+    while n < ticks:
+        t = metrics.clock()
+        span = 1 << (KMAX - gx.bin.astype(np.int64))
+        first = (n % span == 0) & gx.alive
+        gx.vel[first] += 0.5 * gx.acc[first] * (span[first] * h)[:,None]
+
+        nxt = int(((n // span + 1) * span).min())
+        drift(gx, (nxt - n) * h)
+        t = metrics.lap("integrate", t)
+        gx.pos[:,0] = (gx.pos[:,0] + L) % (2*L) - L
+        gx.pos[:,1] = (gx.pos[:,1] + L) % (2*L) - L
+        metrics.lap("wrap", t)
+        n = nxt
+
+        done = (n % span == 0) & gx.alive
+        acc = force(gx, active=done)
+
+        t = metrics.clock()
+        gx.acc[done] = acc[done]
+        gx.vel[done] += 0.5 * gx.acc[done] * (span[done] * h)[:,None]
+
+        # a particle may only lengthen its step where the new step lines up with n
+        aligned = KMAX - min((n & -n).bit_length() - 1, KMAX)
+        gx.bin[done] = np.maximum(timestep_bins(gx.acc[done]), aligned)
+        metrics.lap("integrate", t)
+
+
+
+def timestep_bins(acc):
+    # dt = ETA sqrt(eps / |a|), rounded down to deltaT / 2^k
+    a = np.maximum(np.linalg.norm(acc, axis=1), 1e-12)
+    k = np.ceil(np.log2(deltaT / (ETA * np.sqrt(eps / a))))
+    return np.clip(k, 0, KMAX).astype(np.int8)
+
+
+
+def accel(gx, active=None, theta=THETA):
+    # active: mask of the particles whose acceleration is needed
+    t = metrics.clock()
+    if SOLVER == "fmm":
+        acc = fmm.accel(gx.pos, gx.masses)
+        metrics.lap("force", t)
+        return acc
+    if SOLVER == "pm":
+        acc = pm.accel(gx.pos, gx.masses)
+        metrics.lap("force", t)
+        return acc
+
+    if gx.pool is not None and SOLVER == "tree":
+        acc = gx.pool.accel(active, theta)
+        metrics.lap("force", t)
+        return acc
+
+    order, tree = retree(gx)
+    at = slice(None) if order is None else order
+
+    acc = np.zeros((gx.N, 2), dtype=np.float32)
+    mask = active[at] if active is not None else None
 
     # ------------------------------
-    # 6. Periodic boundaries
+    # 4. Barnes–Hut force evaluation
     # ------------------------------
-    gx.pos[:,0] = (gx.pos[:,0] + L) % (2*L) - L
-    gx.pos[:,1] = (gx.pos[:,1] + L) % (2*L) - L
-
-
-    # print(np.max(np.linalg.norm(gx.pos, axis=1)))
-
-
-    # for i in range(N):
-    #     for j in range(i+1,N):
-
-    #         # if (gx.active[i] and gx.active[j]):
-    #             dr = gx.pos[j]-gx.pos[i]
-    #             dist = np.linalg.norm(dr)
-    #             if ( dist  <  (np.sqrt(gx.masses[i])+np.sqrt(gx.masses[j]))/8  ):
-    #                 collision(i,j,gx)
-
-
-
-
-def morton2D(x, y):
-    x = (x | (x << 8)) & 0x00FF00FF
-    x = (x | (x << 4)) & 0x0F0F0F0F
-    x = (x | (x << 2)) & 0x33333333
-    x = (x | (x << 1)) & 0x55555555
-
-    y = (y | (y << 8)) & 0x00FF00FF
-    y = (y | (y << 4)) & 0x0F0F0F0F
-    y = (y | (y << 2)) & 0x33333333
-    y = (y | (y << 1)) & 0x55555555
-
-    return x | (y << 1)
-
-
-
-
-# def collision(i ,j,gx):
-#     if (gx.masses[i] > gx.masses[j]): collision(j,i,gx)
-#     m1 = min(gx.masses[i],gx.masses[j])
-#     m2 = max(gx.masses[i],gx.masses[j])
-#     if(m1*3 < m2):
-#         merge(j,i,gx)
-#     else:
-#         inelastic_collision(i,j,gx)
-    
-
-# def inelastic_collision(i ,j,gx):
-#     m1 = gx.masses[i]
-#     m2 = gx.masses[j]
-#     v1 = gx.vel[i]
-#     v2 = gx.vel[j]
-#     gx.vel[i] = (m1-e*m2)/(m1+m2)*v1 + ((1+e)*m2)/(m1+m2)*v2
-#     gx.vel[j] = ((1+e)*m1)/(m1+m2)*v1 +  (m2-e*m1)/(m1+m2)*v2
-
-# def merge(i,j,gx):
-#     m1 = gx.masses[i]
-#     m2 = gx.masses[j]
-#     v1 = gx.vel[i]
-#     v2 = gx.vel[j]
-
-#     gx.masses[i] = m1+m2
-#     gx.pos[i] = (m1 * gx.pos[i] + m2 * gx.pos[j])/(m1+m2)
-#     gx.vel[i] = (m1*v1+m2*v2)/(m1+m2)
-    
-#     gx.masses[j] = np.random.uniform(5,10)
-#     addOnMerge(j,gx)
-    
-#     # gx.active[j] = 0
-
-
-
-# def addOnMerge(j,gx):
-#     gx.masses[j] = np.random.uniform(5,10)
-#     edge = np.random.randint(4)
-#     speedx = np.random.uniform(0,2)
-#     speedy = np.random.uniform(0,2)
+    t = metrics.clock()
+    if SOLVER == "treepm":
+        acc[at] = tree.accel(THETA_SR, rs=RS, active=mask)
+        acc += pm.accel(gx.pos, gx.masses, rs=RS)
+    else:
+        acc[at] = tree.accel(theta, active=mask)
+    metrics.lap("force", t)
+    return acc
+
+
+
+def retree(gx):
+    # refit last step's tree while no particle has drifted more than DRIFT
+    # cells since it was built, otherwise rebuild from the old order;
+    # order comes back None while gx storage is itself in tree order
+    tree, order = gx.tree, gx.morton
+    if tree is not None and tree.N == gx.N:
+        pos = gx.pos if order is None else gx.pos[order]
+        d = np.abs(pos - tree.anchor)
+        shift = np.maximum(d[:,0], d[:,1])
+        if shift.max() < DRIFT * 2*L / GRID:
+            t = metrics.clock()
+            tree.refit(pos, gx.masses if order is None else gx.masses[order], shift)
+            metrics.lap("refit", t)
+            gx.refits += 1
+            return order, tree
+
+        if order is None:
+            order = np.arange(gx.N)
+
+    order, tree = build(gx.pos, gx.masses, order if tree is not None else None)
+    tree.anchor = tree.pos.copy()
+    gx.morton, gx.tree = order, tree
+    gx.rebuilds += 1
+    return order, tree
+
+
+
+def build(pos, masses, prev=None):
+    # ------------------------------
+    # 1. Morton ordering
+    # ------------------------------
+    t = metrics.clock()
+    ix = ((pos[:,0] + L) / (2*L) * GRID).astype(np.uint32)
+    iy = ((pos[:,1] + L) / (2*L) * GRID).astype(np.uint32)
 
-#     if (edge == 0):
-#         y = np.random.uniform(-100,100)
-#         gx.pos[j] = (-100,y)
-#         gx.vel[j] = (speedx, (speedy if (y<0) else -speedy))
-#     elif (edge == 1):
-#         x = np.random.uniform(-100,100)
-#         gx.pos[j] = (x,100)
-#         gx.vel[j] = ((speedx if (x<0) else -speedx), -speedy)
-#     elif (edge == 2):
-#         y = np.random.uniform(-100,100)
-#         gx.pos[j] = (100,y)
-#         gx.vel[j] = (-speedx, (speedy if (y<0) else -speedy))
-#     else:
-#         x = np.random.uniform(-100,100)
-#         gx.pos[j] = (x,-100)
-#         gx.vel[j] = ((speedx if (x<0) else -speedx), speedy)
+    ix = np.clip(ix, 0, GRID-1)
+    iy = np.clip(iy, 0, GRID-1)
 
+    codes = morton2D(ix, iy)
+    if prev is None or len(prev) != len(codes):
+        order = np.argsort(codes)
+    else:
+        # the previous order is nearly sorted already, timsort finishes it in ~O(N)
+        order = prev[np.argsort(codes[prev], kind='stable')]
+    metrics.lap("morton", t)
 
+    # ------------------------------
+    # 2. Build implicit nodes (ranges)
+    # 3. Compute node mass + COM
+    # ------------------------------
+    tree = Quadtree(codes[order], pos[order], masses[order])
+    return order, tree
+
+
+
+def direct(pos, masses, tile=TILE, targets=None, periodic=False):
+    # exact softened direct sum in tile x tile blocks, the reference
+    # the tree forces are checked against; targets: indices of the
+    # particles to evaluate (all by default); periodic: minimum-image
+    # separations, the reference for the PM and TreePM solvers
+    N = len(pos)
+    t = pos if targets is None else pos[targets]
+    acc = np.zeros((len(t), 2), dtype=np.float32)
+    x, y = pos[:,0], pos[:,1]
+
+    for i in range(0, len(t), tile):
+        xi = t[i:i+tile, 0, None]
+        yi = t[i:i+tile, 1, None]
+
+        for j in range(0, N, tile):
+            dx = x[None, j:j+tile] - xi
+            dy = y[None, j:j+tile] - yi
+            if periodic:
+                dx = (dx + L) % (2*L) - L
+                dy = (dy + L) % (2*L) - L
+
+            dist = np.sqrt(dx*dx + dy*dy) + eps
+            w = G * masses[None, j:j+tile] / (dist*dist*dist)
+
+            acc[i:i+tile, 0] += np.einsum('ij,ij->i', w, dx)
+            acc[i:i+tile, 1] += np.einsum('ij,ij->i', w, dy)
+
+    return acc
+
+
+
+
+# ------------------------------
+# 8. Collisions
+#
+# Two particles touch when closer than RADIUS (sqrt(m_i) + sqrt(m_j)).
+# Candidates come from a grid of cells one contact diameter of the
+# common particles wide (sorted cell keys, 3 x 3 neighbourhood); the few
+# particles too big for it search the cells within their own reach.
+# Contacts are resolved in rounds of disjoint pairs, closest first: a
+# partner more than MERGE_RATIO times heavier swallows the other, which
+# is retired, otherwise an approaching pair bounces inelastically with
+# restitution e.
+# ------------------------------
+def collide(gx):
+    i, j = contacts(gx.pos, gx.masses)
+    dead = ~gx.alive
+    for _ in range(COLLIDE_ROUNDS):
+        live = ~dead[i] & ~dead[j]
+        i, j = i[live], j[live]
+        if len(i) == 0:
+            break
+
+        # pairs whose particles both appear here for the first time
+        k = np.arange(len(i))
+        first = np.full(gx.N, len(i))
+        np.minimum.at(first, i, k)
+        np.minimum.at(first, j, k)
+        now = (first[i] == k) & (first[j] == k)
+
+        resolve(gx, i[now], j[now], dead)
+        i, j = i[~now], j[~now]
+
+    dead &= gx.alive
+    if dead.any():
+        gx.remove(dead)
+    return int(dead.sum())
+
+
+
+def resolve(gx, i, j, dead):
+    # i lighter, j heavier
+    m = gx.masses
+    swap = m[i] > m[j]
+    i, j = np.where(swap, j, i), np.where(swap, i, j)
+
+    merge = m[i] * MERGE_RATIO < m[j]
+    a, b = i[merge], j[merge]
+    m1, m2 = m[a, None].astype(np.float64), m[b, None].astype(np.float64)
+    d = gx.pos[a] - gx.pos[b]
+    d = (d + L) % (2*L) - L
+    gx.pos[b] = (gx.pos[b] + m1 / (m1 + m2) * d + L) % (2*L) - L
+    gx.vel[b] = (m1 * gx.vel[a] + m2 * gx.vel[b]) / (m1 + m2)
+    gx.masses[b] = m[a] + m[b]
+    dead[a] = True
+
+    a, b = i[~merge], j[~merge]
+    d = gx.pos[b] - gx.pos[a]
+    d = (d + L) % (2*L) - L
+    closing = ((gx.vel[b] - gx.vel[a]) * d).sum(axis=1) < 0
+    a, b = a[closing], b[closing]
+    m1, m2 = m[a, None].astype(np.float64), m[b, None].astype(np.float64)
+    v1, v2 = gx.vel[a], gx.vel[b]
+    gx.vel[a] = ((m1 - e*m2) * v1 + (1 + e) * m2 * v2) / (m1 + m2)
+    gx.vel[b] = ((1 + e) * m1 * v1 + (m2 - e*m1) * v2) / (m1 + m2)
+
+
+
+def contacts(pos, masses):
+    # touching pairs (i < j), closest (relative to the contact distance) first;
+    # cells are sized for the common particles, capped at twice the
+    # CELL_QUANTILE radius so one giant does not coarsen the whole grid
+    N = len(pos)
+    r = RADIUS * np.sqrt(masses.astype(np.float64))
+    none = np.zeros(0, dtype=np.int64)
+    if N < 2 or r.max() <= 0:
+        return none, none
+
+    h = 2 * min(r.max(), 2 * np.quantile(r, CELL_QUANTILE))
+    n = max(int(2*L / h), 1)
+    c = np.clip(((pos + L) / (2*L) * n).astype(np.int64), 0, n-1)
+    key = c[:,0] * n + c[:,1]
+    order = np.argsort(key)
+    skey = key[order]
+
+    def cells(keys, who):
+        # (who[k], every particle in cell keys[k])
+        lo = np.searchsorted(skey, keys)
+        cnt = np.searchsorted(skey, keys, side='right') - lo
+        return np.repeat(who, cnt), order[np.repeat(lo, cnt) + ramp(cnt)]
+
+    # targets in cell order, so the lookups walk skey nearly in order
+    pi, pj = [], []
+    for s in range(0, N, CHUNK // 16):
+        t = order[s : s + CHUNK // 16]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                a, b = cells((c[t,0] + dx) % n * n + (c[t,1] + dy) % n, t)
+                pi.append(a[a < b])
+                pj.append(b[a < b])
+
+    # particles bigger than a cell: the cells within their reach, and
+    # every other big one directly
+    big = np.flatnonzero(r > h / 2)
+    for p in big:
+        k = int(np.ceil((r[p] + h / 2) / h))
+        if (2*k + 1) ** 2 >= N or 2*k + 1 >= n:
+            b = np.arange(N)
+        else:
+            ox, oy = np.meshgrid(np.arange(-k, k+1), np.arange(-k, k+1))
+            keys = np.unique((c[p,0] + ox.ravel()) % n * n + (c[p,1] + oy.ravel()) % n)
+            _, b = cells(keys, keys)
+        pi.append(np.full(len(b), p))
+        pj.append(b)
+    pi.append(np.repeat(big, len(big)))
+    pj.append(np.tile(big, len(big)))
+
+    i, j = np.concatenate(pi), np.concatenate(pj)
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    i, j = i[i != j], j[i != j]
+    if len(big) or n < 3:
+        # the big particles' searches (or a grid that wraps onto itself) repeat pairs
+        _, first = np.unique(i * N + j, return_index=True)
+        i, j = i[first], j[first]
+    d = pos[j] - pos[i]
+    d = (d + L) % (2*L) - L
+    d2 = (d.astype(np.float64)**2).sum(axis=1)
+    touch = d2 < (r[i] + r[j])**2
+    i, j = i[touch], j[touch]
+    rank = np.argsort(d2[touch] / (r[i] + r[j])**2, kind='stable')
+    return i[rank], j[rank]
@@ -1,11 +1,19 @@
 import numpy as np
+import time
 from galaxy import Galaxy
 import glfw
 import moderngl
-from kernel import update
+import backends
+from parallel import Pool
+from sim import Simulation
+from trajectory import Writer
+import metrics
+import diagnostics
+import config
 
 
 N = 100
+REPORT = 120    # frames per frame-time report
 
 # ---------------- OpenGL ----------------
 
@@ -57,8 +65,11 @@ void main() {
 
 def main():
     # init simulation
+    backend = backends.select()
+    print(f"backend: {backend.name}")
+
     gx = Galaxy(N)
-    gx.rando()
+    gx.rando(config.SEED)
 
     gx.add(3, (0,0), (0,0))
 
@@ -70,6 +81,10 @@ def main():
 
     print(gx)
 
+    if config.WORKERS != 1:
+        Pool(gx, config.WORKERS)
+    backend.warm_up(gx)     # forces for the first step's opening kick
+
     # init window
     glfw.init()
 
@@ -97,52 +112,82 @@ def main():
         fragment_shader=FRAGMENT_SHADER,
     )
 
-    data = np.zeros(
-    N,
-    dtype=[('pos','f4',2), ('mass','f4'), 
-           ('color','f4',3)
-           ]
-)
+    writer = Writer(config.RECORD, gx.by_id(gx.masses), tol=config.TRAJ_TOL) if config.RECORD else None
+    sim = Simulation(gx, backend, writer)
 
-    data['pos']   = gx.pos
-    data['mass']  = gx.masses
-    data['color'] = np.random.uniform(0.4, 1.0, (N,3))  # random bright colors
-    data['color'][-1] = (1,1,1)
+    # one buffer per attribute, all in particle id order: positions stream
+    # every frame from the latest snapshot, mass and colour only go up
+    # when they change
+    color = np.random.uniform(0.4, 1.0, (gx.capacity,3)).astype(np.float32)  # random bright colors
+    color[-1] = (1,1,1)     # the central mass, added last
+    frame = sim.snapshot(np.empty_like(sim.latest))
 
+    vbo_pos = ctx.buffer(frame)
+    vbo_mass = ctx.buffer(sim.masses)
+    vbo_color = ctx.buffer(color)
+    uploaded = sim.revision
 
-    vbo = ctx.buffer(data.tobytes())
     vao = ctx.vertex_array(
     prog,
-    [(vbo, "2f 1f 3f", "in_pos", "in_mass", "in_color")]
+    [(vbo_pos, "2f", "in_pos"), (vbo_mass, "1f", "in_mass"), (vbo_color, "3f", "in_color")]
 )
 
     prog["scale"].value = 100
 
-    running = False
-
     def key_callback(window, key, scancode, action, mods):
-        nonlocal running
         if key == glfw.KEY_SPACE and action == glfw.PRESS:
-            running = not running
+            sim.toggle()
+        elif key == glfw.KEY_P and action == glfw.PRESS:
+            metrics.enable(not metrics.enabled)
+            glfw.set_window_title(window, "StarForge")
 
     glfw.set_key_callback(window, key_callback)
+    sim.start()
+
+    timing = np.zeros(3)    # snapshot, upload, draw seconds since the last report
+    frames = 0
+    steps, t_report = 0, time.perf_counter()
 
-    # main loop
+    # main loop, at display rate whatever a step costs
     while not glfw.window_should_close(window):
         glfw.poll_events()
+        t0 = time.perf_counter()
 
-        if running:
-            update(gx)
+        sim.snapshot(frame, config.INTERPOLATE)
 
+        t1 = time.perf_counter()
+        if sim.revision != uploaded:
+            vbo_mass.write(sim.masses)
+            uploaded = sim.revision
+        vbo_pos.write(frame)
 
-        data['pos'] = gx.pos
-        data['mass'] = gx.masses
-        vbo.write(data.tobytes())
+        t2 = time.perf_counter()
         ctx.clear(0.0, 0.0, 0.0)
         vao.render(mode=moderngl.POINTS)
         glfw.swap_buffers(window)
 
+        timing += (t1 - t0, t2 - t1, time.perf_counter() - t2)
+        frames += 1
+        if frames == REPORT:
+            snap, upload, draw = timing / frames * 1e3
+            rate = (sim.steps - steps) / (time.perf_counter() - t_report)
+            print(f"frame {snap+upload+draw:.2f} ms: snapshot {snap:.2f}  upload {upload:.2f}  "
+                  f"draw {draw:.2f}  | sim {rate:.1f} steps/s")
+            if metrics.enabled:
+                # HUD: the rolling step profile in the title bar
+                print(metrics.line())
+                glfw.set_window_title(window, f"StarForge | {rate:.1f} steps/s | {metrics.line()}")
+            if diagnostics.every:
+                print(diagnostics.line())
+            timing[:] = 0
+            frames = 0
+            steps, t_report = sim.steps, time.perf_counter()
+
+    sim.stop()
     glfw.terminate()
+    print(f"tree rebuilds {gx.rebuilds}, refits {gx.refits}")
+    if gx.pool is not None:
+        gx.pool.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
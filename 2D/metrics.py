@@ -0,0 +1,90 @@
+import time
+from collections import deque
+import config
+
+PROFILE = config.PROFILE
+PROFILE_WINDOW = config.PROFILE_WINDOW
+
+# ------------------------------
+# Per-step profile: seconds spent in each phase of kernel.update plus
+# interaction counters, one dict per finished step in `history`
+#
+#   morton     Morton codes + sort          nodes      tree topology
+#   moments    masses, COMs, multipoles     refit      refitting last step's tree
+#   force      force evaluation (walk)      integrate  kicks, drifts, timestep bins
+#   wrap       periodic boundaries          sort       Morton re-layout of the Galaxy
+#   collide    contact search + resolution  diagnostics  energy / momentum sample
+#   step       the whole update
+#
+#   far        particle-node interactions   near       particle-particle interactions
+#   opened     nodes opened by the walk
+#
+# Switched off, clock / lap / count only test a flag. Profiling switched
+# on mid-step leaves clock()'s 0.0 start in the running laps: those, and
+# that first partial step, are dropped rather than timed since the epoch.
+# ------------------------------
+PHASES = ["morton", "nodes", "moments", "refit", "force", "integrate", "wrap", "sort", "collide", "diagnostics"]
+COUNTS = ["far", "near", "opened"]
+
+enabled = PROFILE
+current = {}
+history = deque(maxlen=PROFILE_WINDOW)
+
+
+def enable(on=True):
+    global enabled, current
+    enabled = on
+    current = {}
+    history.clear()
+
+
+def clock():
+    return time.perf_counter() if enabled else 0.0
+
+
+def lap(name, t0):
+    # charge the time since t0 to a phase, returns now for the next lap
+    if not enabled or not t0:
+        return 0.0
+    now = time.perf_counter()
+    current[name] = current.get(name, 0.0) + now - t0
+    return now
+
+
+def count(name, n):
+    if enabled:
+        current[name] = current.get(name, 0) + int(n)
+
+
+def finish(t0):
+    # close the step started at t0
+    global current
+    if not enabled:
+        return
+    if not t0:
+        current = {}
+        return
+    current["step"] = time.perf_counter() - t0
+    history.append(current)
+    current = {}
+
+
+def last():
+    return dict(history[-1]) if history else {}
+
+
+def summary():
+    # mean of every phase and counter over the last PROFILE_WINDOW steps
+    steps = list(history)
+    keys = {k for s in steps for k in s}
+    return {k: sum(s.get(k, 0) for s in steps) / len(steps) for k in keys} if steps else {}
+
+
+def line():
+    s = summary()
+    if not s:
+        return "profile: no steps" if enabled else "profile: off"
+    total = s["step"]
+    phases = "  ".join(f"{k} {s[k]*1e3:.1f}" for k in PHASES if k in s)
+    counts = "  ".join(f"{k} {s[k]:.3g}" for k in COUNTS if k in s)
+    return f"step {total*1e3:.1f} ms: {phases}  | {counts}"
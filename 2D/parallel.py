@@ -0,0 +1,137 @@
+import numpy as np
+import multiprocessing as mp
+from types import SimpleNamespace
+from multiprocessing import shared_memory
+import config
+import kernel
+import metrics
+
+THETA = config.THETA
+WORKERS = config.WORKERS
+COLLIDE = config.COLLIDE
+
+
+# ------------------------------
+# Shared-memory worker pool for the Barnes–Hut force
+#
+# pos / vel / masses / acc and the active mask live in shared memory and
+# the Galaxy arrays are rebound as views on them, so nothing is pickled
+# per step: the pipes only carry the opening angle and the profiling
+# switch one way, and whether the tree was refit plus the walk's
+# interaction counters (metrics.COUNTS) the other. Every worker keeps its
+# own (deterministic) tree, refit or rebuilt through kernel.retree, and
+# walks the active leaf buckets of a contiguous Morton slice, balanced by
+# particle count, writing straight into acc.
+#
+#   python bench.py --engines numpy --workers 1 2 4 8 16
+#
+# reports the scaling.
+# ------------------------------
+class Pool:
+    def __init__(self, gx, workers=WORKERS):
+        if COLLIDE:
+            raise ValueError("collisions retire particles, which the worker pool's fixed arrays cannot follow")
+        self.gx = gx
+        self.workers = workers or mp.cpu_count()
+        self.shm = []
+
+        N = gx.N
+        gx.pos = self.share(gx.pos)
+        gx.vel = self.share(gx.vel)
+        gx.masses = self.share(gx.masses)
+        gx.morton = self.share(np.arange(N, dtype=np.int64))
+        self.acc = self.share(np.zeros((N, 2), dtype=np.float32))
+        self.active = self.share(np.ones(N, dtype=bool))
+        gx.store.update(pos=gx.pos, vel=gx.vel, masses=gx.masses)
+
+        names = [s.name for s in self.shm]
+        ctx = mp.get_context("fork")
+        self.conns, self.procs = [], []
+        for rank in range(self.workers):
+            a, b = ctx.Pipe()
+            p = ctx.Process(target=work, args=(b, names, N, rank, self.workers), daemon=True)
+            p.start()
+            self.conns.append(a)
+            self.procs.append(p)
+
+        gx.pool = self
+
+
+    def share(self, arr):
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        self.shm.append(shm)
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[:] = arr
+        return view
+
+
+    def accel(self, active=None, theta=THETA):
+        # active: mask of the particles whose acceleration is needed
+        self.active[:] = True if active is None else active
+        for c in self.conns:
+            c.send(("accel", theta, metrics.enabled))
+        replies = [c.recv() for c in self.conns]
+        for _, counts in replies:
+            for name, n in counts.items():
+                metrics.count(name, n)
+        refit = replies[0][0]
+        if refit:
+            self.gx.refits += 1
+        else:
+            self.gx.rebuilds += 1
+        return self.acc.copy()
+
+
+    def close(self):
+        for c in self.conns:
+            c.send("stop")
+        for p in self.procs:
+            p.join()
+
+        # hand the Galaxy private copies back before the blocks go away
+        gx = self.gx
+        gx.pos, gx.vel, gx.masses = gx.pos.copy(), gx.vel.copy(), gx.masses.copy()
+        gx.store.update(pos=gx.pos, vel=gx.vel, masses=gx.masses)
+        gx.morton = gx.morton.copy() if gx.morton is not None else None
+        gx.pool = None
+        self.acc = self.active = None
+        for s in self.shm:
+            s.close()
+            s.unlink()
+        self.shm = []
+
+
+
+def work(conn, names, N, rank, workers):
+    shm = [shared_memory.SharedMemory(name=n) for n in names]
+    layout = [((N, 2), np.float32), ((N, 2), np.float32), ((N,), np.float32),
+              ((N,), np.int64), ((N, 2), np.float32), ((N,), bool)]
+    pos, vel, masses, morton, acc, active = (
+        np.ndarray(shape, dtype=dtype, buffer=s.buf) for s, (shape, dtype) in zip(shm, layout)
+    )
+    local = SimpleNamespace(pos=pos, masses=masses, N=N, tree=None, morton=None, refits=0, rebuilds=0)
+
+    while True:
+        msg = conn.recv()
+        if msg == "stop":
+            break
+        _, theta, metrics.enabled = msg
+        metrics.current = {}
+        refits = local.refits
+        order, tree = kernel.retree(local)
+
+        # leaf buckets whose first particle falls in this rank's share
+        ls = tree.start[tree.leaves]
+        lo, hi = np.searchsorted(ls, [rank * N // workers, (rank+1) * N // workers])
+        s = ls[lo] if lo < len(ls) else N
+        e = ls[hi] if hi < len(ls) else N
+
+        if lo < hi:
+            acc[order[s:e]] = tree.accel(theta, span=(lo, hi), active=active[order])[s:e]
+        if rank == 0:
+            morton[:] = order
+        counts = {k: n for k, n in metrics.current.items() if k in metrics.COUNTS}
+        conn.send((local.refits > refits, counts))
+
+    for s in shm:
+        s.close()
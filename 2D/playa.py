@@ -2,15 +2,37 @@ import numpy as np
 import glfw
 import moderngl
 import os
+import sys
+import time
+from trajectory import Reader
 
 # ---------------- LOAD DATA ----------------
 
+# python playa.py [run.traj | history.npy]; a .npy history takes its
+# masses from mass.npy beside it, and with no trajectory the old
+# history.npy + mass.npy next to this file play. Memory-mapped either way
+# so only the frames shown are ever read. A trajectory still being
+# written plays live: new frames are picked up every REFRESH frames.
 HERE = os.path.dirname(__file__)
-history = np.load(os.path.join(HERE, "history.npy"))
-masses = np.load(os.path.join(HERE, "mass.npy"))
-T, N, _ = history.shape
+PATH = sys.argv[1] if len(sys.argv) > 1 else os.path.join(HERE, "history.traj")
+if not PATH.endswith(".npy") and not os.path.exists(PATH):
+    PATH = os.path.join(HERE, "history.npy")
+
+if PATH.endswith(".npy"):
+    history = np.load(PATH, mmap_mode="r")
+    masses = np.load(os.path.join(os.path.dirname(PATH), "mass.npy"))
+else:
+    history = Reader(PATH)
+    while len(history) == 0:
+        # live file, the first frames are not out yet
+        time.sleep(0.2)
+        history.refresh()
+    masses = history.masses
+T, N = len(history), len(masses)
 
 SPEED = 5   # larger = slower
+SEEK = 50   # frames skipped by LEFT / RIGHT
+REFRESH = 60    # frames between looks for newly appended frames
 frame = 0
 
 # ---------------- SHADERS ----------------
@@ -25,7 +47,8 @@ uniform float scale;
 out vec3 v_color;
 
 void main() {
-    gl_Position = vec4(in_pos / scale, 0.0, 1.0);
+    // retired particles are massless: park them outside the view
+    gl_Position = in_mass > 0.0 ? vec4(in_pos / scale, 0.0, 1.0) : vec4(2.0, 2.0, 0.0, 1.0);
     gl_PointSize = 2.0 * sqrt(in_mass);
     v_color = in_color;
 }
@@ -46,6 +69,7 @@ void main() {
 # ---------------- MAIN ----------------
 
 def main():
+    global T
     glfw.init()
     glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
     glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
@@ -63,19 +87,12 @@ def main():
         fragment_shader=FRAGMENT_SHADER,
     )
 
-    data = np.zeros(
-        N,
-        dtype=[('pos','f4',2), ('mass','f4'), ('color','f4',3)]
-    )
-
-    data['pos']   = history[0]
-    data['mass']  = masses
-    data['color'] = np.random.uniform(0.4, 1.0, (N,3))
-
-    vbo = ctx.buffer(data.tobytes())
+    vbo_pos = ctx.buffer(np.ascontiguousarray(history[0]))
+    vbo_mass = ctx.buffer(np.ascontiguousarray(masses, dtype=np.float32))
+    vbo_color = ctx.buffer(np.random.uniform(0.4, 1.0, (N,3)).astype(np.float32))
     vao = ctx.vertex_array(
         prog,
-        [(vbo, "2f 1f 3f", "in_pos", "in_mass", "in_color")]
+        [(vbo_pos, "2f", "in_pos"), (vbo_mass, "1f", "in_mass"), (vbo_color, "3f", "in_color")]
     )
 
     prog["scale"].value = 100
@@ -84,20 +101,35 @@ def main():
     t = 0
 
     def key_cb(win, key, sc, action, mods):
-        nonlocal running
+        nonlocal running, t
+        if action not in (glfw.PRESS, glfw.REPEAT):
+            return
         if key == glfw.KEY_SPACE and action == glfw.PRESS:
             running = not running
+        elif key == glfw.KEY_RIGHT:
+            t = (t + SEEK) % T
+        elif key == glfw.KEY_LEFT:
+            t = (t - SEEK) % T
 
     glfw.set_key_callback(window, key_cb)
 
     # ---------------- LOOP ----------------
 
+    shown = 0
+    shown_masses = masses
     while not glfw.window_should_close(window):
         glfw.poll_events()
-
+        shown += 1
+        if isinstance(history, Reader) and shown % REFRESH == 0:
+            history.refresh()
+            T = len(history)
+
+        vbo_pos.write(np.ascontiguousarray(history[t]))
+        if isinstance(history, Reader) and history.masses_at(t) is not shown_masses:
+            # merges and removals recorded with the frames
+            shown_masses = history.masses_at(t)
+            vbo_mass.write(np.ascontiguousarray(shown_masses, dtype=np.float32))
         if running:
-            data['pos'] = history[t]
-            vbo.write(data.tobytes())
             t = (t + 1) % T
 
         ctx.clear(0, 0, 0)
@@ -0,0 +1,323 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+import config
+
+L = config.L
+TRAJ_TOL = config.TRAJ_TOL
+KEYFRAME = config.KEYFRAME
+
+# ------------------------------
+# Trajectory files
+#
+# <name>       64-byte header | masses (N f4) | frames, appended in chunks
+# <name>.idx   one u64 byte offset per frame, appended with each chunk
+# <name>.mass  (version 2) u64 first frame | masses (N f4), one record
+#              whenever the masses change; dead particles are massless
+#
+# The header never changes after creation and the frame count is the
+# index length, so a run can be recorded frame by frame and replayed
+# (memory-mapped, one frame paged in at a time) while it is still going.
+# The header masses hold until the first .mass record.
+#
+# Codecs
+#   RAW    every frame is N x dim f4
+#   DELTA  blocks of up to `keyframe` frames, one index entry per frame all
+#          pointing at their block: u32 length | zlib(keyframe f4, then
+#          int16 steps of 2 tol L per frame), byte-shuffled before deflate.
+#          Steps are taken against the decoder's own reconstruction, so the
+#          error stays within tol L (plus float32 rounding) however long
+#          the block; a frame moving too far for int16 starts a new block.
+# ------------------------------
+MAGIC = b"NBODYTRJ"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQIIdd")   # magic, version, dim, N, codec, keyframe, step, box
+HEADER_SIZE = 64
+RAW = 0
+DELTA = 1
+LENGTH = struct.Struct("<I")
+FIRST = struct.Struct("<Q")     # frame a .mass record applies from
+
+CHUNK_FRAMES = 16   # frames buffered per append
+
+
+class Writer:
+    def __init__(self, path, masses, dim=2, chunk=CHUNK_FRAMES, tol=0.0, keyframe=KEYFRAME, box=L):
+        # tol: max position error in units of box (0: RAW), box: half the
+        # periodic box the positions wrap in
+        masses = np.ascontiguousarray(masses, dtype=np.float32)
+        self.N = len(masses)
+        self.dim = dim
+        self.codec = DELTA if tol else RAW
+        self.chunk = keyframe if tol else chunk
+        self.step = 2 * tol * box
+        self.box = box
+        self.pending = []
+        self.key = None
+        self.masses = masses.copy()
+
+        self.file = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.mass = open(path + ".mass", "wb")
+        header = HEADER.pack(MAGIC, VERSION, dim, self.N, self.codec, self.chunk, self.step, box)
+        self.file.write(header.ljust(HEADER_SIZE, b"\0"))
+        self.file.write(masses.tobytes())
+        self.file.flush()   # a Reader can open the file before the first chunk
+        self.offset = self.file.tell()
+        self.frames = 0
+
+
+    @classmethod
+    def reopen(cls, path, frames):
+        # carry on recording into an existing file after its first `frames`
+        # frames (a resumed run), dropping whatever was recorded after them
+        r = Reader(path)
+        frames = min(frames, len(r))
+        keep = []
+        if frames == 0:
+            cut, indexed = HEADER_SIZE + 4*r.N, 0
+        elif r.codec == RAW:
+            cut, indexed = int(r.index[frames-1]) + r.N*r.dim*4, frames
+        else:
+            # a block running past the cut is cut whole and its first
+            # frames re-encoded
+            offset = r.index[frames-1]
+            first = int(np.searchsorted(r.index, offset))
+            last = int(np.searchsorted(r.index, offset, side="right"))
+            size, = LENGTH.unpack_from(r.data, int(offset))
+            cut, indexed = int(offset) + LENGTH.size + size, frames
+            if last > frames:
+                keep = [r[t].copy() for t in range(first, frames)]
+                cut, indexed = int(offset), first
+        masses = (r.masses_at(frames-1) if frames else r.masses).copy()
+        changes = int((r.changes["first"] < frames).sum())
+        w = cls.__new__(cls)
+        w.N, w.dim, w.codec, w.chunk, w.step, w.box = r.N, r.dim, r.codec, r.keyframe, r.step, r.box
+        del r
+
+        os.truncate(path, cut)
+        os.truncate(path + ".idx", indexed * 8)
+        if os.path.exists(path + ".mass"):
+            os.truncate(path + ".mass", changes * (FIRST.size + 4*w.N))
+        w.pending, w.key, w.masses = [], None, masses
+        w.file = open(path, "ab")
+        w.index = open(path + ".idx", "ab")
+        w.mass = open(path + ".mass", "ab")
+        w.offset, w.frames = cut, indexed
+        for pos in keep:
+            w.append(pos)
+        return w
+
+
+    def append(self, pos, masses=None):
+        # masses: the particles' current masses (dead ones 0), recorded
+        # from this frame on when they differ from the last recorded
+        if masses is not None:
+            masses = np.asarray(masses, dtype=np.float32)
+            if not np.array_equal(masses, self.masses):
+                self.masses = masses.copy()
+                self.mass.write(FIRST.pack(self.frames + len(self.pending)) + self.masses.tobytes())
+                self.mass.flush()
+
+        pos = np.asarray(pos, dtype=np.float32).reshape(self.N, self.dim)
+        if self.codec == RAW:
+            self.pending.append(pos.tobytes())
+        elif self.key is None:
+            self.key, self.S, self.recon = pos.copy(), np.zeros(pos.shape, np.int32), pos.copy()
+            self.pending.append(pos)
+        else:
+            d = wrap(pos - self.recon.astype(np.float64), self.box)
+            q = np.rint(d / self.step)
+            if np.abs(q).max() > 32767:
+                self.flush()
+                return self.append(pos)
+            q = q.astype(np.int16)
+            self.S += q
+            self.recon = restore(self.key, self.S, self.step, self.box)
+            self.pending.append(q)
+
+        if len(self.pending) >= self.chunk:
+            self.flush()
+
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.codec == RAW:
+            sizes = [len(p) for p in self.pending]
+            offsets = self.offset + np.concatenate(([0], np.cumsum(sizes[:-1])))
+            data = b"".join(self.pending)
+        else:
+            # one block: the keyframe and its steps deflated together
+            body = shuffle(self.pending[0]) + (shuffle(np.stack(self.pending[1:])) if len(self.pending) > 1 else b"")
+            body = zlib.compress(body, 1)
+            data = LENGTH.pack(len(body)) + body
+            offsets = np.full(len(self.pending), self.offset)
+            self.key = None
+
+        # frames first, then their offsets: a reader never sees an index
+        # entry whose frame is not fully written
+        self.file.write(data)
+        self.file.flush()
+        self.index.write(offsets.astype(np.uint64).tobytes())
+        self.index.flush()
+
+        self.offset += len(data)
+        self.frames += len(self.pending)
+        self.pending = []
+
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index.close()
+        self.mass.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class Reader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.dim, self.N, self.codec, self.keyframe, self.step, self.box = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+        if version not in (1, VERSION):
+            raise ValueError(f"{path}: unsupported trajectory version {version}")
+        if self.codec not in (RAW, DELTA):
+            raise ValueError(f"{path}: unknown trajectory codec {self.codec}")
+
+        self.masses = np.frombuffer(self.data, dtype=np.float32, count=self.N, offset=HEADER_SIZE)
+        self.record = np.dtype([("first", "<u8"), ("masses", "<f4", (self.N,))])
+        self.changes = np.zeros(0, dtype=self.record)
+        self.current = 0, self.masses
+        self.shown = None
+        self.block = None
+        self.refresh()
+
+
+    def refresh(self):
+        # pick up frames appended since the file was opened
+        n = os.path.getsize(self.path + ".idx") // 8
+        self.index = np.memmap(self.path + ".idx", dtype=np.uint64, mode="r", shape=(n,)) if n else []
+        mass = self.path + ".mass"
+        n = os.path.getsize(mass) // self.record.itemsize if os.path.exists(mass) else 0
+        if n > len(self.changes):
+            self.changes = np.memmap(mass, dtype=self.record, mode="r", shape=(n,))
+        if os.path.getsize(self.path) > len(self.data):
+            with open(self.path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.masses = np.frombuffer(self.data, dtype=np.float32, count=self.N, offset=HEADER_SIZE)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def masses_at(self, t):
+        # masses in effect at frame t, the same array until they change
+        k = int(np.searchsorted(self.changes["first"], t, side="right"))
+        if k != self.current[0]:
+            self.current = k, self.changes["masses"][k-1] if k else self.masses
+        return self.current[1]
+
+
+    def __getitem__(self, t):
+        # view straight into the mapping: only this frame's pages are read,
+        # and the previous frame's are handed back so resident memory stays
+        # at about one frame however long the file is
+        offset = int(self.index[t])
+        if self.shown is not None and self.shown[0] != offset:
+            self.release(*self.shown)
+
+        if self.codec == RAW:
+            self.shown = offset, self.N*self.dim*4
+            return np.frombuffer(self.data, dtype=np.float32, count=self.N*self.dim,
+                                 offset=offset).reshape(self.N, self.dim)
+
+        # DELTA: decode the whole block once, then play it from memory
+        if self.shown is None or self.shown[0] != offset:
+            first = int(np.searchsorted(self.index, self.index[t]))
+            count = int(np.searchsorted(self.index, self.index[t], side="right")) - first
+            size, = LENGTH.unpack_from(self.data, offset)
+            body = zlib.decompress(self.data[offset + LENGTH.size : offset + LENGTH.size + size])
+            self.block = first, self.decode(body, count)
+            self.shown = offset, LENGTH.size + size
+        first, frames = self.block
+        return frames[t - first]
+
+
+    def decode(self, body, count):
+        shape = (self.N, self.dim)
+        nkey = self.N * self.dim * 4
+        frames = np.empty((count,) + shape, dtype=np.float32)
+        frames[0] = unshuffle(body[:nkey], np.float32).reshape(shape)
+        if count > 1:
+            S = unshuffle(body[nkey:], np.int16).reshape((count-1,) + shape)
+            S = np.cumsum(S, axis=0, dtype=np.int32)
+            frames[1:] = restore(frames[0], S, self.step, self.box)
+        return frames
+
+
+    def release(self, offset, size):
+        if hasattr(mmap, "MADV_DONTNEED"):
+            start = offset - offset % mmap.PAGESIZE
+            self.data.madvise(mmap.MADV_DONTNEED, start, offset + size - start)
+
+
+
+# ------------------------------
+# DELTA codec helpers, shared by Writer and Reader so both reconstruct
+# exactly the same positions
+# ------------------------------
+def wrap(x, box):
+    return (x + box) % (2*box) - box
+
+
+def restore(key, S, step, box):
+    # key + step S back into the box, in float32 and without %, which
+    # dominated decoding
+    x = S.astype(np.float32)
+    x *= np.float32(step)
+    x += key
+    x -= np.float32(2*box) * np.floor((x + np.float32(box)) * np.float32(0.5 / box))
+    return x
+
+
+def shuffle(a):
+    # bytes grouped by significance: the high bytes of small steps are
+    # nearly all 0x00 / 0xff and deflate well
+    a = np.ascontiguousarray(a)
+    return a.view(np.uint8).reshape(-1, a.itemsize).T.tobytes()
+
+
+def unshuffle(b, dtype):
+    size = np.dtype(dtype).itemsize
+    return np.frombuffer(b, dtype=np.uint8).reshape(size, -1).T.copy().view(dtype)
+
+
+
+def convert(history, masses, path, tol=TRAJ_TOL):
+    # old history.npy (T x N x 2) + mass.npy -> trajectory, streamed
+    frames = np.load(history, mmap_mode="r")
+    with Writer(path, np.load(masses), dim=frames.shape[2], tol=float(tol)) as w:
+        for frame in frames:
+            w.append(frame)
+
+
+
+if __name__ == "__main__":
+    # python trajectory.py history.npy mass.npy history.traj [tol, 0 for RAW]
+    convert(*sys.argv[1:5])
@@ -0,0 +1,453 @@
+import numpy as np
+from math import comb, factorial
+from pm import potential
+import metrics
+import config
+
+G = config.G
+eps = config.eps
+BITS = config.BITS
+THETA = config.THETA
+LEAF = config.LEAF
+CHUNK = config.CHUNK
+ORDER = config.ORDER
+RCUT = config.RCUT
+L = config.L
+
+GROUPS = 4096   # leaf groups walked together per batch
+
+
+class Quadtree:
+    def __init__(self, codes, pos, mass, leaf=LEAF, order=ORDER):
+        # codes / pos / mass must already be in Morton order
+        self.N = len(codes)
+        self.pos = pos.astype(np.float64)
+        self.mass = mass.astype(np.float64)
+        self.box_size = 2 * L
+        self.order = order
+
+        t = metrics.clock()
+        self.build(codes, leaf)
+        t = metrics.lap("nodes", t)
+        self.moments()
+        if order >= 2:
+            self.multipoles()
+        metrics.lap("moments", t)
+
+
+    def refit(self, pos, mass, shift):
+        # same topology for moved particles (shift: how far each one has
+        # drifted): redo the moments and widen every node by the largest
+        # drift inside it so the opening test stays safe
+        self.pos = pos.astype(np.float64)
+        self.mass = mass.astype(np.float64)
+        self.moments()
+        if self.order >= 2:
+            self.multipoles()
+
+        grow = np.zeros(len(self.start))
+        grow[self.leaves] = np.maximum.reduceat(shift, self.start[self.leaves])
+        for level in range(self.levels-2, -1, -1):
+            lo, hi = self.offset[level], self.offset[level+1]
+            ids = np.arange(lo, hi)
+            ids = ids[self.nchild[ids] > 0]
+            if len(ids) == 0:
+                continue
+            grow[ids] = np.maximum.reduceat(grow[hi:self.offset[level+2]], self.child[ids] - hi)
+        self.size = self.box_size / 2.0**self.level + 2*grow
+
+
+    # ------------------------------
+    # Topology: one pass per level over the sorted codes
+    # ------------------------------
+    def build(self, codes, leaf):
+        N = self.N
+        starts = [np.array([0])]
+        ends = [np.array([N])]
+        firsts = []
+        counts = []
+
+        for level in range(1, BITS+1):
+            s, e = starts[-1], ends[-1]
+            split = (e - s) > leaf
+            if not split.any():
+                break
+            ps, pe = s[split], e[split]
+
+            # particles covered by a node that gets subdivided
+            inside = np.cumsum(
+                np.bincount(ps, minlength=N+1) - np.bincount(pe, minlength=N+1)
+            )[:N] > 0
+
+            prefix = codes >> (2*(BITS-level))
+            brk = np.ones(N, dtype=bool)
+            brk[1:] = prefix[1:] != prefix[:-1]
+            brk[ps] = True
+
+            cs = np.flatnonzero(brk & inside)
+            parent = np.searchsorted(ps, cs, side='right') - 1
+            ce = np.minimum(np.append(cs[1:], N), pe[parent])
+
+            first = np.full(len(s), -1)
+            first[split] = np.searchsorted(cs, ps)
+            cnt = np.zeros(len(s), dtype=np.int64)
+            cnt[split] = np.bincount(parent, minlength=len(ps))
+            firsts.append(first)
+            counts.append(cnt)
+
+            starts.append(cs)
+            ends.append(ce)
+
+        firsts.append(np.full(len(starts[-1]), -1))
+        counts.append(np.zeros(len(starts[-1]), dtype=np.int64))
+
+        sizes = [len(s) for s in starts]
+        offset = np.concatenate(([0], np.cumsum(sizes)))
+
+        self.levels = len(starts)
+        self.offset = offset
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.level = np.repeat(np.arange(self.levels), sizes)
+        self.size = self.box_size / 2.0**self.level
+        self.nchild = np.concatenate(counts)
+        self.child = np.concatenate([
+            np.where(f >= 0, f + offset[l+1], -1) for l, f in enumerate(firsts)
+        ])
+        self.leaves = np.flatnonzero(self.nchild == 0)
+        self.leaves = self.leaves[np.argsort(self.start[self.leaves])]
+
+
+    # ------------------------------
+    # Mass + COM, leaves first then parent by parent level
+    # ------------------------------
+    def moments(self):
+        n = len(self.start)
+        self.M = np.zeros(n)
+        mx = np.zeros((n, 2))
+
+        leaves = self.leaves
+        ls = self.start[leaves]
+        self.M[leaves] = np.add.reduceat(self.mass, ls)
+        mx[leaves] = np.add.reduceat(self.mass[:,None] * self.pos, ls)
+
+        for level in range(self.levels-2, -1, -1):
+            lo, hi = self.offset[level], self.offset[level+1]
+            ids = np.arange(lo, hi)
+            ids = ids[self.nchild[ids] > 0]
+            if len(ids) == 0:
+                continue
+            first = self.child[ids] - hi
+            self.M[ids] = np.add.reduceat(self.M[hi:self.offset[level+2]], first)
+            mx[ids] = np.add.reduceat(mx[hi:self.offset[level+2]], first)
+
+        self.com = np.divide(mx, self.M[:,None], out=np.zeros_like(mx), where=self.M[:,None] > 0)
+
+
+    # ------------------------------
+    # Complex moments sum m w^k conj(w)^l about each COM, up to k+l = order
+    # ------------------------------
+    def multipoles(self):
+        terms = expansion_terms(self.order)
+        index = {kl: t for t, kl in enumerate(terms)}
+        self.Q = np.zeros((len(self.start), len(terms)), dtype=np.complex128)
+
+        z = self.pos[:,0] + 1j*self.pos[:,1]
+        c = self.com[:,0] + 1j*self.com[:,1]
+
+        leaves = self.leaves
+        ls = self.start[leaves]
+        w = z - np.repeat(c[leaves], self.end[leaves] - ls)
+        wc = np.conj(w)
+        for t, (k, l) in enumerate(terms):
+            self.Q[leaves, t] = np.add.reduceat(self.mass * w**k * wc**l, ls)
+
+        for level in range(self.levels-2, -1, -1):
+            lo, hi = self.offset[level], self.offset[level+1]
+            ids = np.arange(lo, hi)
+            ids = ids[self.nchild[ids] > 0]
+            if len(ids) == 0:
+                continue
+            kids = np.arange(hi, self.offset[level+2])
+            parent = np.repeat(ids, self.nchild[ids])
+
+            # shift every child expansion to its parent's COM
+            s = c[kids] - c[parent]
+            sc = np.conj(s)
+            Qk = self.Q[kids]
+            shifted = np.zeros_like(Qk)
+            for t, (k, l) in enumerate(terms):
+                for (i, j), u in index.items():
+                    if i <= k and j <= l:
+                        shifted[:,t] += comb(k, i) * comb(l, j) * s**(k-i) * sc**(l-j) * Qk[:,u]
+
+            self.Q[ids] = np.add.reduceat(shifted, self.child[ids] - hi)
+
+
+    # ------------------------------
+    # Group walk: every leaf bucket shares one interaction list
+    # ------------------------------
+    def walk(self, groups, theta, cut=None):
+        # with a cut-off (TreePM short range) distances are minimum-image
+        # and nodes entirely beyond the cut-off are dropped
+        lo = np.minimum.reduceat(self.pos, self.start[self.leaves])[groups]
+        hi = np.maximum.reduceat(self.pos, self.start[self.leaves])[groups]
+        gc = 0.5 * (lo + hi)
+        gh = 0.5 * (hi - lo)
+
+        g = np.arange(len(groups))
+        n = np.zeros(len(groups), dtype=np.int64)
+        far, near = [], []
+
+        while len(g):
+            d = self.com[n] - gc[g]
+            if cut:
+                d = (d + L) % (2*L) - L
+            d = np.maximum(np.abs(d) - gh[g], 0.0)
+            d2 = (d*d).sum(axis=1)
+            ok = self.size[n]**2 < theta*theta * d2
+            keep = self.M[n] > 0
+            if cut:
+                keep &= np.sqrt(d2) - np.sqrt(2)*self.size[n] < cut
+            far.append((g[ok & keep], n[ok & keep]))
+
+            keep &= ~ok
+            g, n = g[keep], n[keep]
+
+            leaf = self.nchild[n] == 0
+            near.append((g[leaf], n[leaf]))
+            g, n = g[~leaf], n[~leaf]
+            metrics.count("opened", len(n))
+
+            cnt = self.nchild[n]
+            g = np.repeat(g, cnt)
+            n = np.repeat(self.child[n], cnt) + ramp(cnt)
+
+        far = tuple(np.concatenate(x) for x in zip(*far))
+        near = tuple(np.concatenate(x) for x in zip(*near))
+        return far, near
+
+
+    def accel(self, theta=THETA, rs=None, span=None, active=None):
+        # rs: TreePM split scale, the tree then only supplies the
+        # short-range part of the force (see pm.split)
+        # span: (first, last) leaf buckets to compute targets for
+        # active: mask (tree order) of the targets wanted, others may stay 0
+        acc = np.zeros((2, self.N))
+        leaves = self.leaves
+        self.xy = np.ascontiguousarray(self.pos.T, dtype=np.float32)
+        cut = rs * RCUT if rs else None
+        first, last = span or (0, len(leaves))
+
+        ids = np.arange(first, last)
+        if active is not None:
+            ids = ids[np.add.reduceat(active, self.start[leaves])[ids] > 0]
+
+        for c in range(0, len(ids), GROUPS):
+            groups = ids[c:c+GROUPS]
+            (fg, fn), (ng, nn) = self.walk(groups, theta, cut)
+
+            gs = self.start[leaves[groups]]
+            gn = self.end[leaves[groups]] - gs
+
+            # far field: node monopoles (or full expansions)
+            if self.order >= 2 and not rs:
+                self.expand(acc, gs[fg], gn[fg], self.com[fn], self.Q[fn])
+            else:
+                self.interact(acc, gs[fg], gn[fg], self.com[fn], self.M[fn], rs)
+
+            # near field: every particle of the neighbouring leaves
+            cnt = self.end[nn] - self.start[nn]
+            j = np.repeat(self.start[nn], cnt) + ramp(cnt)
+            g = np.repeat(ng, cnt)
+            self.interact(acc, gs[g], gn[g], self.pos[j], self.mass[j], rs)
+            if metrics.enabled:
+                metrics.count("far", gn[fg].sum())
+                metrics.count("near", gn[g].sum())
+
+        return acc.T.astype(np.float32)
+
+
+    def interact(self, acc, ts, tn, src, m, rs=None):
+        # pair k applies source k to targets ts[k] .. ts[k]+tn[k]-1
+        sx, sy = np.ascontiguousarray(src.T, dtype=np.float32)
+        x, y = self.xy
+        m = m.astype(np.float32)
+        total = np.cumsum(tn)
+        cut = np.searchsorted(total, np.arange(CHUNK, total[-1] if len(total) else 0, CHUNK))
+
+        for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+            if a == b:
+                continue
+            cnt = tn[a:b]
+            t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+            k = np.repeat(np.arange(a, b), cnt)
+
+            dx = sx[k] - x[t]
+            dy = sy[k] - y[t]
+
+            if rs:
+                # minimum image, short-range share of the force
+                dx = (dx + L) % (2*L) - L
+                dy = (dy + L) % (2*L) - L
+                r = np.sqrt(dx*dx + dy*dy)
+                dist = r + eps
+                w = G * m[k] * np.exp(-r*r / (2*rs*rs)) * (
+                    1 / (dist*dist*dist) + (2*r + eps) / (2*rs*rs * dist*dist)
+                )
+            else:
+                dist = np.sqrt(dx*dx + dy*dy) + eps
+                w = G * m[k] / (dist*dist*dist)
+
+            acc[0] += np.bincount(t, weights=w*dx, minlength=self.N)
+            acc[1] += np.bincount(t, weights=w*dy, minlength=self.N)
+
+
+    def potential(self, theta=THETA):
+        # potential at every particle (tree order), node monopoles for the
+        # far field (this pair potential's own expansion converges too
+        # slowly at the usual opening angles to gain from more); each
+        # particle's own term is taken back out
+        phi = np.zeros(self.N)
+        leaves = self.leaves
+        self.xy = np.ascontiguousarray(self.pos.T, dtype=np.float32)
+
+        for c in range(0, len(leaves), GROUPS):
+            groups = np.arange(c, min(c + GROUPS, len(leaves)))
+            (fg, fn), (ng, nn) = self.walk(groups, theta)
+
+            gs = self.start[leaves[groups]]
+            gn = self.end[leaves[groups]] - gs
+            self.pair_potential(phi, gs[fg], gn[fg], self.com[fn], self.M[fn])
+
+            cnt = self.end[nn] - self.start[nn]
+            j = np.repeat(self.start[nn], cnt) + ramp(cnt)
+            g = np.repeat(ng, cnt)
+            self.pair_potential(phi, gs[g], gn[g], self.pos[j], self.mass[j])
+
+        return phi - G * self.mass * potential(0.0)
+
+
+    def pair_potential(self, phi, ts, tn, src, m):
+        # as interact, summing G m potential(|d|) instead of the force
+        sx, sy = np.ascontiguousarray(src.T, dtype=np.float32)
+        x, y = self.xy
+        m = m.astype(np.float32)
+        total = np.cumsum(tn)
+        cut = np.searchsorted(total, np.arange(CHUNK, total[-1] if len(total) else 0, CHUNK))
+
+        for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+            if a == b:
+                continue
+            cnt = tn[a:b]
+            t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+            k = np.repeat(np.arange(a, b), cnt)
+
+            r = np.hypot(sx[k] - x[t], sy[k] - y[t])
+            phi += np.bincount(t, weights=G * m[k] * potential(r), minlength=self.N)
+
+
+    def expand(self, acc, ts, tn, src, Q):
+        # far field from the complex moments of each source node:
+        # a = G sum_kl Q_kl/(k! l!) d^k/dw^k d^l/dwc^l [u H(u conj(u))]
+        # with u = d + w and H(rho) = (sqrt(rho) + eps)^-3
+        x, y = self.xy
+        keys, mix = EXPANSION[self.order]
+        H = DERIVS[self.order]
+        C = (G * (Q @ mix)).astype(np.complex64)
+
+        total = np.cumsum(tn)
+        step = max(1, CHUNK // len(keys))
+        cut = np.searchsorted(total, np.arange(step, total[-1] if len(total) else 0, step))
+
+        for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+            if a == b:
+                continue
+            cnt = tn[a:b]
+            t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+            k = np.repeat(np.arange(a, b), cnt)
+
+            d = (src[k,0] - x[t]) + 1j*(src[k,1] - y[t])
+            d = d.astype(np.complex64)
+            r = np.abs(d)
+            ir = [np.ones_like(r), 1.0 / r]
+            ie = [np.ones_like(r), 1.0 / (r + eps)]
+            for _ in range(2*self.order):
+                ir.append(ir[-1] * ir[1])
+            for _ in range(self.order + 2):
+                ie.append(ie[-1] * ie[1])
+            Hn = [sum(c * ir[i] * ie[j] for c, i, j in h) for h in H]
+
+            dp = [np.ones_like(d), d]
+            for _ in range(self.order):
+                dp.append(dp[-1] * d)
+            dc = [np.conj(v) for v in dp]
+
+            f = np.zeros_like(d)
+            for u, (p, q, n) in enumerate(keys):
+                f += C[k,u] * (dp[p] * dc[q] * Hn[n])
+
+            acc[0] += np.bincount(t, weights=f.real, minlength=self.N)
+            acc[1] += np.bincount(t, weights=f.imag, minlength=self.N)
+
+
+
+def expansion_terms(order):
+    # dipole terms vanish about the centre of mass
+    return [(k, n-k) for n in range(order+1) for k in range(n+1) if n != 1]
+
+
+def hderiv(n):
+    # n-th derivative of H(rho) = (sqrt(rho) + eps)^-3 in rho, as a list of
+    # (coeff, a, b) meaning coeff * r^-a * (r + eps)^-b
+    h = {(0, 3): 1.0}
+    for _ in range(n):
+        dh = {}
+        for (a, b), c in h.items():
+            dh[(a+2, b)] = dh.get((a+2, b), 0.0) - 0.5*a*c
+            dh[(a+1, b+1)] = dh.get((a+1, b+1), 0.0) - 0.5*b*c
+        h = {ab: c for ab, c in dh.items() if c != 0}
+    return [(c, a, b) for (a, b), c in h.items()]
+
+
+def expansion(order):
+    # d^k/du^k d^l/dv^l [u H(uv)] = sum_j C(k,j) (l+1)!/(l+1-j)!
+    #                                     u^(l+1-j) v^(k-j) H^(k+l-j)(uv)
+    # returned as the distinct (p, q, n) = u^p v^q H^(n) factors plus the
+    # matrix mapping node moments onto their coefficients
+    terms = expansion_terms(order)
+    keys = {}
+    rows = []
+    for u, (k, l) in enumerate(terms):
+        for j in range(min(k, l+1) + 1):
+            c = comb(k, j) * factorial(l+1) / factorial(l+1-j) / (factorial(k) * factorial(l))
+            key = keys.setdefault((l+1-j, k-j, k+l-j), len(keys))
+            rows.append((u, key, c))
+
+    mix = np.zeros((len(terms), len(keys)))
+    for u, key, c in rows:
+        mix[u, key] += c
+    return list(keys), mix
+
+
+EXPANSION = {p: expansion(p) for p in range(2, 5)}
+DERIVS = {p: [hderiv(n) for n in range(p+1)] for p in range(2, 5)}
+
+
+def morton2D(x, y):
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+
+    y = (y | (y << 8)) & 0x00FF00FF
+    y = (y | (y << 4)) & 0x0F0F0F0F
+    y = (y | (y << 2)) & 0x33333333
+    y = (y | (y << 1)) & 0x55555555
+
+    return x | (y << 1)
+
+
+def ramp(cnt):
+    # 0..cnt[0]-1, 0..cnt[1]-1, ...
+    return np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
@@ -0,0 +1,214 @@
+import os
+import sys
+import numpy as np
+from galaxy import Galaxy
+import kernel
+import config
+
+G = config.G
+eps = config.eps
+THETA = config.THETA
+BITS = config.BITS
+BACKEND = config.BACKEND
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# ------------------------------
+# Backends: one force evaluation + one integration step each
+# ------------------------------
+class Backend:
+    name = None
+
+    def accel(self, gx, active=None):
+        # active: mask of the particles whose acceleration is needed
+        raise NotImplementedError
+
+    def warm_up(self, gx):
+        kernel.warm_up(gx, self.accel)
+
+    def update(self, gx):
+        kernel.update(gx, self.accel)
+
+
+class Python(Backend):
+    # the original pair loop, kept as the reference the others are checked against
+    name = "python"
+
+    def accel(self, gx, active=None):
+        N = gx.N
+        pos = gx.pos.tolist()
+        m = gx.masses.tolist()
+        acc = [[0.0, 0.0, 0.0] for _ in range(N)]
+
+        for i in range(N):
+            for j in range(i+1, N):
+                dx = pos[j][0] - pos[i][0]
+                dy = pos[j][1] - pos[i][1]
+                dz = pos[j][2] - pos[i][2]
+                r2 = dx*dx + dy*dy + dz*dz + eps*eps
+                invR3 = G / (r2**0.5 * r2)
+
+                acc[i][0] += m[j] * dx * invR3
+                acc[i][1] += m[j] * dy * invR3
+                acc[i][2] += m[j] * dz * invR3
+                acc[j][0] -= m[i] * dx * invR3
+                acc[j][1] -= m[i] * dy * invR3
+                acc[j][2] -= m[i] * dz * invR3
+
+        return np.array(acc, dtype=np.float32)
+
+
+class NumPy(Backend):
+    # vectorized Barnes–Hut
+    name = "numpy"
+
+    def accel(self, gx, active=None, theta=THETA):
+        return kernel.barnes_hut(gx, theta, active)
+
+
+class Numba(Backend):
+    # the same octree and quadrupoles, walked leaf bucket by leaf bucket
+    # in compiled parallel loops
+    name = "numba"
+
+    def accel(self, gx, active=None, theta=THETA):
+        order, tree = kernel.build(gx.pos, gx.masses)
+        gx.morton, gx.tree = order, tree
+
+        leaves = tree.leaves
+        if active is not None:
+            leaves = leaves[np.add.reduceat(active[order], tree.start[leaves]) > 0]
+
+        Q = tree.Q if tree.order >= 2 else np.zeros((len(tree.M), 6))
+        acc = np.zeros((gx.N, 3), dtype=np.float32)
+        acc[order] = jit_walk(tree.pos, tree.mass, tree.start, tree.end, tree.nchild, tree.child,
+                              tree.size, tree.M, tree.com, Q, leaves, theta)
+        return acc
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def jit_walk(pos, mass, start, end, nchild, child, size, M, com, Q, leaves, theta):
+        N = len(pos)
+        acc = np.zeros((N, 3), dtype=np.float32)
+        t2 = theta * theta
+        e2 = eps * eps
+
+        for g in numba.prange(len(leaves)):
+            s, e = start[leaves[g]], end[leaves[g]]
+            lo = pos[s].copy()
+            hi = pos[s].copy()
+            for i in range(s+1, e):
+                for c in range(3):
+                    lo[c] = min(lo[c], pos[i,c])
+                    hi[c] = max(hi[c], pos[i,c])
+
+            stack = np.empty(8*(BITS+2), dtype=np.int64)
+            stack[0] = 0
+            top = 1
+            while top:
+                top -= 1
+                n = stack[top]
+                if M[n] <= 0:
+                    continue
+
+                d2 = 0.0
+                for c in range(3):
+                    d = max(abs(com[n,c] - 0.5*(lo[c] + hi[c])) - 0.5*(hi[c] - lo[c]), 0.0)
+                    d2 += d*d
+
+                if size[n]*size[n] < t2 * d2:
+                    qxx, qyy, qzz, qxy, qxz, qyz = G*Q[n,0], G*Q[n,1], G*Q[n,2], G*Q[n,3], G*Q[n,4], G*Q[n,5]
+                    for i in range(s, e):
+                        dx = com[n,0] - pos[i,0]
+                        dy = com[n,1] - pos[i,1]
+                        dz = com[n,2] - pos[i,2]
+                        r2 = dx*dx + dy*dy + dz*dz + e2
+                        w = G * M[n] / (np.sqrt(r2)*r2)
+
+                        # quadrupole, as in Octree.interact
+                        qdx = qxx*dx + qxy*dy + qxz*dz
+                        qdy = qxy*dx + qyy*dy + qyz*dz
+                        qdz = qxz*dx + qyz*dy + qzz*dz
+                        h1 = -1.5 / (r2*r2*np.sqrt(r2))
+                        h2 = -2.5 / r2 * h1
+                        radial = h1 * (qxx + qyy + qzz) + 2*h2 * (dx*qdx + dy*qdy + dz*qdz)
+                        acc[i,0] += w*dx + radial*dx + 2*h1*qdx
+                        acc[i,1] += w*dy + radial*dy + 2*h1*qdy
+                        acc[i,2] += w*dz + radial*dz + 2*h1*qdz
+                elif nchild[n] == 0:
+                    for i in range(s, e):
+                        for j in range(start[n], end[n]):
+                            dx = pos[j,0] - pos[i,0]
+                            dy = pos[j,1] - pos[i,1]
+                            dz = pos[j,2] - pos[i,2]
+                            r2 = dx*dx + dy*dy + dz*dz + e2
+                            w = G * mass[j] / (np.sqrt(r2)*r2)
+                            acc[i,0] += w * dx
+                            acc[i,1] += w * dy
+                            acc[i,2] += w * dz
+                else:
+                    for c in range(nchild[n]):
+                        stack[top] = child[n] + c
+                        top += 1
+        return acc
+
+
+BACKENDS = {"python": Python, "numpy": NumPy}
+if numba is not None:
+    BACKENDS["numba"] = Numba
+
+FASTEST = ["numba", "numpy"]
+TOL = 0.05     # relative rms error a tree backend may show against the pair loop
+
+
+# ------------------------------
+# Selection: --backend NAME, then $GRAVITY_BACKEND, then config.BACKEND
+# ------------------------------
+def select(name=None, argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for i, arg in enumerate(argv):
+        if arg.startswith("--backend="):
+            name = name or arg.split("=", 1)[1]
+        elif arg == "--backend" and i+1 < len(argv):
+            name = name or argv[i+1]
+    name = name or os.environ.get("GRAVITY_BACKEND") or BACKEND
+
+    if name == "auto":
+        errors = check([n for n in FASTEST if n in BACKENDS], verbose=False)
+        name = next((n for n in errors if errors[n] < TOL), None)
+        if name is None:
+            # never the O(N^2) pair loop behind the user's back
+            print("backend: no backend passed the self-check ("
+                  + ", ".join(f"{n} rel. error {errors[n]:.2e}" for n in errors)
+                  + f", tolerance {TOL}), using numpy")
+            name = "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r}, available: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+def check(names=None, N=256, seed=0, verbose=True):
+    # relative rms deviation of every backend from the pair loop on one fixed galaxy
+    gx = Galaxy(N)
+    gx.rando(seed)
+    gx.pos *= 50    # spread well beyond the softening length
+
+    ref = Python().accel(gx).astype(np.float64)
+    errors = {}
+    for name in names or BACKENDS:
+        a = BACKENDS[name]().accel(gx)
+        errors[name] = float(np.linalg.norm(a - ref) / np.linalg.norm(ref))
+        if verbose:
+            status = "ok" if errors[name] < TOL else "FAIL"
+            print(f"{name:8s} rel. error {errors[name]:.2e}  {status}")
+    return errors
+
+
+
+if __name__ == "__main__":
+    check()
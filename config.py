@@ -0,0 +1,23 @@
+
+
+M = 3.0
+deltaT = 0.1
+G = 0.1
+eps = 2
+e = 0.7
+BITS = 21
+THETA = 0.8
+ORDER = 2       # tree expansion order: 0 monopole, 2 quadrupole
+LEAF = 16
+TILE = 1024
+CHUNK = 1 << 20
+KMAX = 0            # deepest block timestep bin, dt = deltaT / 2^k for k <= KMAX (0: one global step, one force evaluation)
+ETA = 0.1           # timestep accuracy, dt = ETA sqrt(eps / |a|)
+INTERPOLATE = True  # draw positions blended between the last two simulation states
+BACKEND = "auto"    # "python", "numpy", "numba" or "auto" (fastest that passes the self-check)
+SEED = None         # initial-condition seed (None: fresh entropy every run)
+COLLIDE = False     # particles closer than RADIUS (sqrt(m_i) + sqrt(m_j)) merge or bounce
+RADIUS = 0.125      # contact radius per sqrt(mass)
+MERGE_RATIO = 3.0   # a partner this many times heavier swallows the other, else they bounce with restitution e
+COMPACT = 0.25      # dead fraction of the particle slots that triggers compaction
+DIAG_EVERY = 0      # energy / momentum / virial sample every k steps (0: off)
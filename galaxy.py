@@ -1,14 +1,31 @@
 import numpy as np
+import config
+
+G = config.G
+eps = config.eps
+COMPACT = config.COMPACT
 
 class Galaxy:
     def __init__(self, N = 10):
-        self.N = N
+        self.N = N          # slots in use, live or dead: what the kernels run over
+        self.count = N      # live particles
         self.vel = np.zeros((N,3), dtype=np.float32)
         self.pos = np.zeros((N,3), dtype=np.float32)
         self.masses = np.zeros(N, dtype=np.float32)
-        # self.active = np.ones(N, dtype=np.float32)
-        self.new = N-1
+        self.alive = np.ones(N, dtype=bool)
         self.morton = np.arange(N, dtype=np.int32)
+        self.ids = np.arange(N)
+        self.capacity = N   # particle ids run 0 .. capacity-1, retired ones leave gaps
+        self.free_slots = []    # dead slots below N, reused first
+        self.free_ids = []      # ids of compacted-away particles, reused first
+        self.steps = 0
+        self.acc = None     # accelerations at the current positions, kernel.warm_up / update
+        self.bin = np.zeros(N, dtype=np.int8)
+        self.tree = None
+        # the per-slot arrays above are views of the first N slots of these
+        self.store = dict(pos=self.pos, vel=self.vel, masses=self.masses, alive=self.alive,
+                          ids=self.ids, bin=self.bin)
+        self.revision = 0   # bumped whenever masses or the slot layout change
 
 
     def __str__(self):
@@ -19,12 +36,12 @@ class Galaxy:
 
         return (
             f"Galaxy(\n"
-            f"  particles : {N}\n"
+            f"  particles : {self.count} (slots {N})\n"
             f"  mass      : min={self.masses.min():.2f}, "
             f"max={self.masses.max():.2f}, "
             f"mean={self.masses.mean():.2f}\n"
             f"  position  : x∈[{pos_min[0]:.2f}, {pos_max[0]:.2f}], "
-            f"y∈[{pos_min[1]:.2f}, {pos_max[1]:.2f}], ",
+            f"y∈[{pos_min[1]:.2f}, {pos_max[1]:.2f}], "
             f"z∈[{pos_min[2]:.2f}, {pos_max[2]:.2f}]\n"
             f"  speed     : min={vel_mag.min():.2f}, "
             f"max={vel_mag.max():.2f}, "
@@ -34,43 +51,120 @@ class Galaxy:
 
 
     def add(self, mass, pos, vel):
-        if(self.new<0): 
-            self.new = self.N
-        self.masses[self.new] = mass
-        self.pos[self.new] = pos
-        self.vel[self.new] = vel
-        self.new -= 1
+        # a new particle in a dead slot (keeping that slot's id), else in
+        # the next slot up with a recycled or fresh id, doubling the
+        # storage when it is full; returns the id
+        if self.free_slots:
+            i = self.free_slots.pop()
+        else:
+            i = self.N
+            if i == min(len(a) for a in self.store.values()):
+                self.grow(2*i or 1)
+            self.slots(i + 1)
+            self.ids[i] = self.free_ids.pop() if self.free_ids else self.capacity
+            self.capacity = max(self.capacity, self.ids[i] + 1)
+            self.morton = None
+        self.masses[i] = mass
+        self.pos[i] = pos
+        self.vel[i] = vel
+        self.bin[i] = 0
+        self.alive[i] = True
+        self.count += 1
+        self.acc = None     # fresh forces and timestep bins next step
+        self.revision += 1
+        return int(self.ids[i])
+
+
+    def remove(self, slots):
+        # retire the particles in slots (indices or a mask): massless and
+        # at rest until the slot is reused, and compacted away once more
+        # than COMPACT of the slots are dead
+        slots = np.asarray(slots)
+        slots = np.flatnonzero(slots) if slots.dtype == bool else slots
+        slots = slots[self.alive[slots]]
+        self.alive[slots] = False
+        self.masses[slots] = 0
+        self.vel[slots] = 0
+        self.bin[slots] = 0
+        if self.acc is not None:
+            self.acc[slots] = 0
+        self.free_slots.extend(slots.tolist())
+        self.count -= len(slots)
+        self.revision += 1
+        if self.N - self.count > COMPACT * self.N:
+            self.compact()
+
+
+    def compact(self):
+        # move the live particles down (in order) so they fill the first
+        # count slots; the dead ones' ids go on the free list
+        keep = self.alive.copy()
+        self.free_ids.extend(self.ids[~keep].tolist())
+        self.free_slots = []
+        n = self.count
+        for name in self.store:
+            a = getattr(self, name)
+            a[:n] = a[keep]
+        if self.acc is not None:
+            self.acc[:n] = self.acc[keep]
+            self.acc = self.acc[:n]
+        self.slots(n)
+        self.morton = None
+        self.revision += 1
+
+
+    def slots(self, n):
+        self.N = n
+        for name, a in self.store.items():
+            setattr(self, name, a[:n])
+
 
+    def grow(self, size):
+        for name, a in self.store.items():
+            b = np.zeros((size,) + a.shape[1:], dtype=a.dtype)
+            b[:self.N] = a[:self.N]
+            self.store[name] = b
 
-    def rando(self):
+
+    def by_id(self, a):
+        # per-particle array back in id order, for the renderer; retired
+        # ids read 0 (massless, so never drawn)
+        out = np.zeros((self.capacity,) + a.shape[1:], dtype=a.dtype)
+        out[self.ids] = a
+        return out
+
+
+    def rando(self, seed=None):
         M = 3.0
         G = 0.1
         eps = 2.0
+        rp, rm = streams(seed, 2)
 
-        theta = np.random.uniform(0, 2*np.pi, self.N)
-        u = np.random.uniform(-1, 1, self.N)
+        theta = rp.uniform(0, 2*np.pi, self.N)
+        u = rp.uniform(-1, 1, self.N)
         phi = np.arccos(u)
 
-        # r = np.random.uniform(10**3, 50**3, self.N) ** (1/3)
-        r = np.random.uniform(0, 1, self.N)
+        # r = rp.uniform(10**3, 50**3, self.N) ** (1/3)
+        r = rp.uniform(0, 1, self.N)
 
         self.pos[:,0] = r * np.sin(phi) * np.cos(theta)
         self.pos[:,1] = r * np.sin(phi) * np.sin(theta)
         self.pos[:,2] = r * np.cos(phi)
 
-        self.masses[:] = np.abs(np.random.normal(2, 0.1, self.N))
-
-        for i in range(self.N):
-            rvec = self.pos[i]
-            dist = np.linalg.norm(rvec) + eps
+        self.masses[:] = np.abs(rm.normal(2, 0.1, self.N))
 
-            vmag = np.sqrt(G * M / dist)
+        dist = np.linalg.norm(self.pos, axis=1) + eps
+        vmag = np.sqrt(G * M / dist)
 
-            ref = np.array([0,0,1]) if abs(rvec[2]/dist) < 0.9 else np.array([0,1,0])
-            t = np.cross(ref, rvec)
-            t /= np.linalg.norm(t)
+        # tangential: z x r, or y x r near the poles
+        ref = np.zeros((self.N, 3))
+        polar = np.abs(self.pos[:,2] / dist) >= 0.9
+        ref[~polar, 2] = 1
+        ref[polar, 1] = 1
+        t = np.cross(ref, self.pos)
+        t /= np.linalg.norm(t, axis=1)[:,None]
 
-            self.vel[i] = vmag * t
+        self.vel[:] = vmag[:,None] * t
 
     # def rando(self):
     #     theta = np.random.uniform(0, 2*np.pi, self.N)
@@ -88,15 +182,17 @@ class Galaxy:
 
 
 
-    def big_bang(self):
+    def big_bang(self, seed=None):
+        rp, rm = streams(seed, 2)
+
         # random positions in small sphere
-        self.pos[:] = np.random.normal(0, 1.0, (self.N, 3))
+        self.pos[:] = rp.normal(0, 1.0, (self.N, 3))
         r = np.linalg.norm(self.pos, axis=1)
         self.pos /= r[:,None]
-        self.pos *= np.random.uniform(1, 5, (self.N,1))
+        self.pos *= rp.uniform(1, 5, (self.N,1))
 
         # nearly uniform masses
-        self.masses[:] = np.abs(np.random.normal(1.0, 0.05, self.N))
+        self.masses[:] = np.abs(rm.normal(1.0, 0.05, self.N))
 
         # outward Hubble velocity
         H0 = 1.0
@@ -104,6 +200,95 @@ class Galaxy:
 
 
 
+    def plummer(self, a=10.0, seed=None):
+        # Plummer sphere of scale radius a
+        rp, rv, rm = streams(seed, 3)
+        self.masses[:] = np.abs(rm.normal(1.0, 0.05, self.N))
+        self.pos[:], self.vel[:] = plummer(self.N, a, self.masses.sum(), rp, rv)
+        self.recentre()
+
+
+
+    def disk(self, rd=10.0, seed=None):
+        # exponential disk of scale length rd in the x-y plane, on circular orbits
+        rp, rv, rm = streams(seed, 3)
+        self.masses[:] = np.abs(rm.normal(1.0, 0.05, self.N))
+        self.pos[:], self.vel[:] = exponential_disk(self.N, rd, self.masses.sum(), rp, rv)
+        self.recentre()
+
+
+
+    def collision(self, sep=60.0, b=10.0, speed=None, rd=5.0, tilt=60.0, seed=None):
+        # two exponential disks sep apart (impact parameter b) falling
+        # together, on a parabolic orbit unless a relative speed is given;
+        # the second disk is tilted by tilt degrees about the x axis
+        ra, va, rb, vb, rm = streams(seed, 5)
+        n = self.N // 2
+        self.masses[:] = np.abs(rm.normal(1.0, 0.05, self.N))
+        m1, m2 = self.masses[:n].sum(), self.masses[n:].sum()
+        if speed is None:
+            speed = np.sqrt(2 * G * (m1 + m2) / np.hypot(sep, b))
+
+        pa, wa = exponential_disk(n, rd, m1, ra, va)
+        pb, wb = exponential_disk(self.N - n, rd, m2, rb, vb)
+        c, s = np.cos(np.radians(tilt)), np.sin(np.radians(tilt))
+        R = np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+        pb, wb = pb @ R.T, wb @ R.T
+
+        # centre-of-mass frame, the second disk heading back along x
+        d, v = np.array([sep, b, 0.0]), np.array([-speed, 0.0, 0.0])
+        f1, f2 = m1 / (m1 + m2), m2 / (m1 + m2)
+        self.pos[:n], self.vel[:n] = pa - f2*d, wa - f2*v
+        self.pos[n:], self.vel[n:] = pb + f1*d, wb + f1*v
+        self.recentre()
+
+
+    def recentre(self):
+        # centre of mass at rest at the origin, removing the sampling drift
+        self.pos -= np.average(self.pos, axis=0, weights=self.masses).astype(np.float32)
+        self.vel -= np.average(self.vel, axis=0, weights=self.masses).astype(np.float32)
+
+
+
+# ------------------------------
+# Initial conditions: vectorized, every quantity drawn from its own
+# stream of one seed, so a setup is reproducible exactly and does not
+# shift when another draw is added
+# ------------------------------
+def streams(seed, n):
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n)]
+
+
+def isotropic(n, rng):
+    u = rng.normal(size=(n, 3))
+    return u / np.linalg.norm(u, axis=1)[:,None]
+
+
+def plummer(n, a, mass, rp, rv, cut=0.99):
+    # radii from M(<r) / mass = r^3 / (r^2 + a^2)^(3/2), inverted, up to the
+    # radius holding cut of the mass; speeds q v_esc with q^2 ~ Beta(3/2, 9/2)
+    u = rp.uniform(0, cut, n)
+    r = a / np.sqrt(u**(-2/3) - 1)
+    pos = r[:,None] * isotropic(n, rp)
+
+    q = np.sqrt(rv.beta(1.5, 4.5, n))
+    vesc = np.sqrt(2 * G * mass) * (r*r + a*a)**-0.25
+    vel = (q * vesc)[:,None] * isotropic(n, rv)
+    return pos, vel
+
 
+def exponential_disk(n, rd, mass, rp, rv, sigma=0.05, thick=0.1):
+    # surface density ~ exp(-R/rd), so R ~ Gamma(2, rd), gaussian in z with
+    # thick rd; circular speed in the enclosed mass (taken as spherical)
+    # under Plummer softening, plus sigma of it in random motion
+    R = rd * rp.gamma(2.0, 1.0, n)
+    phi = rp.uniform(0, 2*np.pi, n)
+    z = rp.normal(0, thick * rd, n)
+    x = R / rd
+    menc = mass * (1 - (1 + x) * np.exp(-x))
+    v = np.sqrt(G * menc * R*R / (R*R + eps*eps)**1.5)
 
-    
\ No newline at end of file
+    c, s = np.cos(phi), np.sin(phi)
+    pos = np.stack([R*c, R*s, z], axis=1)
+    vel = v[:,None] * (np.stack([-s, c, np.zeros(n)], axis=1) + sigma * rv.normal(size=(n, 3)))
+    return pos, vel
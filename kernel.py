@@ -1,105 +1,339 @@
 import numpy as np
 from galaxy import Galaxy
+from tree import Octree, ramp
+import diagnostics
+import config
 
-deltaT = 0.1
-G = 0.1
-eps = 2
-e = 0.7
+deltaT = config.deltaT
+G = config.G
+eps = config.eps
+e = config.e
+BITS = config.BITS
+THETA = config.THETA
+TILE = config.TILE
+KMAX = config.KMAX
+ETA = config.ETA
+CHUNK = config.CHUNK
+COLLIDE = config.COLLIDE
+RADIUS = config.RADIUS
+MERGE_RATIO = config.MERGE_RATIO
+COLLIDE_ROUNDS = 4      # rounds of disjoint pairs resolved per step, the rest waits a step
+CELL_QUANTILE = 0.999   # radius quantile the collision cells are sized from
 
 
 
-def update(gx):
-    N = gx.N
-    acc = np.zeros((N, 3), dtype=np.float32)
-    
-    for i in range(N):
-        for j in range(i+1, N):
+def update(gx, force=None):
+    force = force or barnes_hut
+    if gx.acc is None:
+        warm_up(gx, force)
+    if KMAX:
+        block_step(gx, force)
+    else:
+        # kick-drift-kick: the closing kick's accelerations open the next step
+        # retired slots have acc 0 and stay where they were retired
+        gx.vel += 0.5*gx.acc*deltaT
+        drift(gx, deltaT)
+        gx.acc = live_forces(gx, force)
+        gx.vel += 0.5*gx.acc*deltaT
+    if COLLIDE:
+        collide(gx)
+    # print(np.max(np.linalg.norm(gx.pos, axis=1)))
 
-            # if (gx.active[i] and gx.active[j]):
-                dr = gx.pos[j]-gx.pos[i]
-                r2 = dr[0]*dr[0] + dr[1]*dr[1] + dr[2]*dr[2] + eps*eps
-                invR3 = 1.0/(np.sqrt(r2)*r2)
+    # conservation diagnostics every DIAG_EVERY steps, walking the last
+    # force evaluation's tree for the potential when it is still current
+    gx.steps += 1
+    if diagnostics.due(gx):
+        diagnostics.record(gx, *current_tree(gx))
 
-                acc[i] += G * gx.masses[j] * dr * invR3
-                acc[j] -= G * gx.masses[i] * dr * invR3
 
-    gx.vel += 0.5*acc*deltaT
-    gx.pos += gx.vel*deltaT
-    gx.vel += 0.5*acc*deltaT
-    print(np.max(np.linalg.norm(gx.pos, axis=1)))
 
 
-    # for i in range(N):
-    #     for j in range(i+1,N):
 
-    #         # if (gx.active[i] and gx.active[j]):
-    #             dr = gx.pos[j]-gx.pos[i]
-    #             dist = np.linalg.norm(dr)
-    #             if ( dist  <  (np.sqrt(gx.masses[i])+np.sqrt(gx.masses[j]))/8  ):
-    #                 collision(i,j,gx)
 
 
+def warm_up(gx, force=None):
+    # accelerations at the starting positions, for the opening kick of
+    # the first step, and the first block timestep bins
+    force = force or barnes_hut
+    gx.acc = live_forces(gx, force)
+    gx.bin[:] = np.where(gx.alive, timestep_bins(gx.acc), 0)
 
 
 
+def live_forces(gx, force):
+    # every live particle's acceleration; retired slots are no targets
+    # and read 0, so kicks leave them at rest
+    if gx.count == gx.N:
+        return force(gx)
+    acc = force(gx, active=gx.alive)
+    acc[~gx.alive] = 0
+    return acc
 
 
-# def collision(i ,j,gx):
-#     if (gx.masses[i] > gx.masses[j]): collision(j,i,gx)
-#     m1 = min(gx.masses[i],gx.masses[j])
-#     m2 = max(gx.masses[i],gx.masses[j])
-#     if(m1*3 < m2):
-#         merge(j,i,gx)
-#     else:
-#         inelastic_collision(i,j,gx)
-    
 
-# def inelastic_collision(i ,j,gx):
-#     m1 = gx.masses[i]
-#     m2 = gx.masses[j]
-#     v1 = gx.vel[i]
-#     v2 = gx.vel[j]
-#     gx.vel[i] = (m1-e*m2)/(m1+m2)*v1 + ((1+e)*m2)/(m1+m2)*v2
-#     gx.vel[j] = ((1+e)*m1)/(m1+m2)*v1 +  (m2-e*m1)/(m1+m2)*v2
+def drift(gx, dt):
+    if gx.count == gx.N:
+        gx.pos += gx.vel * dt
+    else:
+        np.add(gx.pos, gx.vel * dt, out=gx.pos, where=gx.alive[:,None])
 
-# def merge(i,j,gx):
-#     m1 = gx.masses[i]
-#     m2 = gx.masses[j]
-#     v1 = gx.vel[i]
-#     v2 = gx.vel[j]
 
-#     gx.masses[i] = m1+m2
-#     gx.pos[i] = (m1 * gx.pos[i] + m2 * gx.pos[j])/(m1+m2)
-#     gx.vel[i] = (m1*v1+m2*v2)/(m1+m2)
-    
-#     gx.masses[j] = np.random.uniform(5,10)
-#     addOnMerge(j,gx)
-    
-#     # gx.active[j] = 0
 
+def block_step(gx, force):
+    # block timesteps: bin k kicks with dt = deltaT / 2^k, everyone drifts
+    # together and only the particles closing a step get new forces
+    # (targets of the active bin, sources from the full tree); retired
+    # slots sit in bin 0 and are never kicked or targeted
+    ticks = 1 << KMAX
+    h = deltaT / ticks
+    n = 0
+    while n < ticks:
+        span = 1 << (KMAX - gx.bin.astype(np.int64))
+        first = (n % span == 0) & gx.alive
+        gx.vel[first] += 0.5 * gx.acc[first] * (span[first] * h)[:,None]
 
+        nxt = int(((n // span + 1) * span).min())
+        drift(gx, (nxt - n) * h)
+        n = nxt
 
-# def addOnMerge(j,gx):
-#     gx.masses[j] = np.random.uniform(5,10)
-#     edge = np.random.randint(4)
-#     speedx = np.random.uniform(0,2)
-#     speedy = np.random.uniform(0,2)
+        done = (n % span == 0) & gx.alive
+        gx.acc[done] = force(gx, active=done)[done]
+        gx.vel[done] += 0.5 * gx.acc[done] * (span[done] * h)[:,None]
 
-#     if (edge == 0):
-#         y = np.random.uniform(-100,100)
-#         gx.pos[j] = (-100,y)
-#         gx.vel[j] = (speedx, (speedy if (y<0) else -speedy))
-#     elif (edge == 1):
-#         x = np.random.uniform(-100,100)
-#         gx.pos[j] = (x,100)
-#         gx.vel[j] = ((speedx if (x<0) else -speedx), -speedy)
-#     elif (edge == 2):
-#         y = np.random.uniform(-100,100)
-#         gx.pos[j] = (100,y)
-#         gx.vel[j] = (-speedx, (speedy if (y<0) else -speedy))
-#     else:
-#         x = np.random.uniform(-100,100)
-#         gx.pos[j] = (x,-100)
-#         gx.vel[j] = ((speedx if (x<0) else -speedx), speedy)
+        # a particle may only lengthen its step where the new step lines up with n
+        aligned = KMAX - min((n & -n).bit_length() - 1, KMAX)
+        gx.bin[done] = np.maximum(timestep_bins(gx.acc[done]), aligned)
 
 
+
+def timestep_bins(acc):
+    # dt = ETA sqrt(eps / |a|), rounded down to deltaT / 2^k
+    a = np.maximum(np.linalg.norm(acc, axis=1), 1e-12)
+    k = np.ceil(np.log2(deltaT / (ETA * np.sqrt(eps / a))))
+    return np.clip(k, 0, KMAX).astype(np.int8)
+
+
+
+def barnes_hut(gx, theta=THETA, active=None):
+    # active: mask of the particles whose acceleration is needed
+    order, tree = build(gx.pos, gx.masses)
+    gx.morton, gx.tree = order, tree
+
+    # ------------------------------
+    # 3. Tree walk
+    # ------------------------------
+    acc = np.zeros_like(gx.pos)
+    acc[order] = tree.accel(theta, active[order] if active is not None else None)
+    return acc
+
+
+
+def current_tree(gx):
+    # the tree of the last force evaluation if positions and masses still
+    # match it (block steps end on one), otherwise a fresh one
+    order, tree = gx.morton, gx.tree
+    if (tree is None or order is None or tree.N != gx.N
+            or not np.array_equal(tree.pos, gx.pos[order]) or not np.array_equal(tree.mass, gx.masses[order])):
+        order, tree = build(gx.pos, gx.masses)
+        gx.morton, gx.tree = order, tree
+    return order, tree
+
+
+
+def build(pos, masses):
+    # ------------------------------
+    # 1. Morton ordering (63-bit, 21 bits per axis)
+    # ------------------------------
+    lo = pos.min(axis=0)
+    box_size = float((pos.max(axis=0) - lo).max()) * (1 + 1e-6) or 1.0
+
+    q = ((pos - lo) / box_size * (1 << BITS)).astype(np.uint64)
+    q = np.minimum(q, np.uint64((1 << BITS) - 1))
+
+    codes = morton3D(q[:,0], q[:,1], q[:,2])
+    order = np.argsort(codes)
+
+    # ------------------------------
+    # 2. Linear octree + bottom-up moments
+    # ------------------------------
+    tree = Octree(codes[order], pos[order], masses[order], box_size)
+    return order, tree
+
+
+
+def direct(pos, masses, tile=TILE, targets=None):
+    # exact softened direct sum, evaluated in tile x tile blocks so the
+    # temporaries stay at O(tile^2) instead of O(N^2); targets: indices
+    # of the particles to evaluate (all by default)
+    N = len(pos)
+    t = pos if targets is None else pos[targets]
+    acc = np.zeros((len(t), 3), dtype=np.float32)
+    x, y, z = pos[:,0], pos[:,1], pos[:,2]
+
+    for i in range(0, len(t), tile):
+        xi = t[i:i+tile, 0, None]
+        yi = t[i:i+tile, 1, None]
+        zi = t[i:i+tile, 2, None]
+
+        for j in range(0, N, tile):
+            dx = x[None, j:j+tile] - xi
+            dy = y[None, j:j+tile] - yi
+            dz = z[None, j:j+tile] - zi
+
+            r2 = dx*dx + dy*dy + dz*dz + eps*eps
+            w = G * masses[None, j:j+tile] / (np.sqrt(r2)*r2)
+
+            acc[i:i+tile, 0] += np.einsum('ij,ij->i', w, dx)
+            acc[i:i+tile, 1] += np.einsum('ij,ij->i', w, dy)
+            acc[i:i+tile, 2] += np.einsum('ij,ij->i', w, dz)
+
+    return acc
+
+
+
+
+def part1by2(x):
+    x = x & np.uint64(0x1FFFFF)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x001F00000000FFFF)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x001F0000FF0000FF)
+    x = (x | (x << np.uint64(8)))  & np.uint64(0x100F00F00F00F00F)
+    x = (x | (x << np.uint64(4)))  & np.uint64(0x10C30C30C30C30C3)
+    x = (x | (x << np.uint64(2)))  & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton3D(x, y, z):
+    return part1by2(x) | (part1by2(y) << np.uint64(1)) | (part1by2(z) << np.uint64(2))
+
+
+
+
+# ------------------------------
+# Collisions
+#
+# Two particles touch when closer than RADIUS (sqrt(m_i) + sqrt(m_j)).
+# Candidates come from a grid of cells one contact diameter of the
+# common particles wide over the bounding box (sorted cell keys, 3 x 3 x 3
+# neighbourhood); the few particles too big for it search the cells
+# within their own reach. Contacts are resolved in rounds of disjoint
+# pairs, closest first: a partner more than MERGE_RATIO times heavier
+# swallows the other, which is retired, otherwise an approaching pair
+# bounces inelastically with restitution e.
+# ------------------------------
+def collide(gx):
+    i, j = contacts(gx.pos, gx.masses)
+    dead = ~gx.alive
+    for _ in range(COLLIDE_ROUNDS):
+        live = ~dead[i] & ~dead[j]
+        i, j = i[live], j[live]
+        if len(i) == 0:
+            break
+
+        # pairs whose particles both appear here for the first time
+        k = np.arange(len(i))
+        first = np.full(gx.N, len(i))
+        np.minimum.at(first, i, k)
+        np.minimum.at(first, j, k)
+        now = (first[i] == k) & (first[j] == k)
+
+        resolve(gx, i[now], j[now], dead)
+        i, j = i[~now], j[~now]
+
+    dead &= gx.alive
+    if dead.any():
+        gx.remove(dead)
+    return int(dead.sum())
+
+
+
+def resolve(gx, i, j, dead):
+    # i lighter, j heavier
+    m = gx.masses
+    swap = m[i] > m[j]
+    i, j = np.where(swap, j, i), np.where(swap, i, j)
+
+    merge = m[i] * MERGE_RATIO < m[j]
+    a, b = i[merge], j[merge]
+    m1, m2 = m[a, None].astype(np.float64), m[b, None].astype(np.float64)
+    gx.pos[b] = (m1 * gx.pos[a] + m2 * gx.pos[b]) / (m1 + m2)
+    gx.vel[b] = (m1 * gx.vel[a] + m2 * gx.vel[b]) / (m1 + m2)
+    gx.masses[b] = m[a] + m[b]
+    dead[a] = True
+
+    a, b = i[~merge], j[~merge]
+    closing = ((gx.vel[b] - gx.vel[a]) * (gx.pos[b] - gx.pos[a])).sum(axis=1) < 0
+    a, b = a[closing], b[closing]
+    m1, m2 = m[a, None].astype(np.float64), m[b, None].astype(np.float64)
+    v1, v2 = gx.vel[a], gx.vel[b]
+    gx.vel[a] = ((m1 - e*m2) * v1 + (1 + e) * m2 * v2) / (m1 + m2)
+    gx.vel[b] = ((1 + e) * m1 * v1 + (m2 - e*m1) * v2) / (m1 + m2)
+
+
+
+def contacts(pos, masses):
+    # touching pairs (i < j), closest (relative to the contact distance) first;
+    # cells are sized for the common particles, capped at twice the
+    # CELL_QUANTILE radius so one giant does not coarsen the whole grid
+    N = len(pos)
+    r = RADIUS * np.sqrt(masses.astype(np.float64))
+    none = np.zeros(0, dtype=np.int64)
+    if N < 2 or r.max() <= 0:
+        return none, none
+
+    # cell coordinates from 1, so every neighbour key stays inside the
+    # padded grid; no more than 2^20 cells a side, so the keys fit 63 bits
+    lo = pos.min(axis=0).astype(np.float64)
+    span = float((pos.max(axis=0) - lo).max())
+    h = max(2 * min(r.max(), 2 * np.quantile(r, CELL_QUANTILE)), span / (1 << 20))
+    c = ((pos - lo) / h).astype(np.int64) + 1
+    n = int(c.max()) + 2
+    key = (c[:,0] * n + c[:,1]) * n + c[:,2]
+    order = np.argsort(key)
+    skey = key[order]
+
+    def cells(keys, who):
+        # (who[k], every particle in cell keys[k])
+        lo = np.searchsorted(skey, keys)
+        cnt = np.searchsorted(skey, keys, side='right') - lo
+        return np.repeat(who, cnt), order[np.repeat(lo, cnt) + ramp(cnt)]
+
+    # targets in cell order, so the lookups walk skey nearly in order
+    near = np.array([(dx * n + dy) * n + dz for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)])
+    pi, pj = [], []
+    for s in range(0, N, CHUNK // 32):
+        t = order[s : s + CHUNK // 32]
+        for o in near:
+            a, b = cells(key[t] + o, t)
+            pi.append(a[a < b])
+            pj.append(b[a < b])
+
+    # particles bigger than a cell: the cells within their reach, and
+    # every other big one directly
+    big = np.flatnonzero(r > h / 2)
+    for p in big:
+        k = int(np.ceil((r[p] + h / 2) / h))
+        if (2*k + 1) ** 3 >= N:
+            b = np.arange(N)
+        else:
+            o = np.arange(-k, k+1)
+            ox, oy, oz = np.meshgrid(o, o, o)
+            cx = np.stack([ox.ravel(), oy.ravel(), oz.ravel()], axis=1) + c[p]
+            cx = cx[((cx >= 0) & (cx < n)).all(axis=1)]
+            _, b = cells((cx[:,0] * n + cx[:,1]) * n + cx[:,2], cx[:,0])
+        pi.append(np.full(len(b), p))
+        pj.append(b)
+    pi.append(np.repeat(big, len(big)))
+    pj.append(np.tile(big, len(big)))
+
+    i, j = np.concatenate(pi), np.concatenate(pj)
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    i, j = i[i != j], j[i != j]
+    if len(big):
+        # the big particles' searches repeat pairs
+        _, first = np.unique(i * N + j, return_index=True)
+        i, j = i[first], j[first]
+    d2 = ((pos[j] - pos[i]).astype(np.float64)**2).sum(axis=1)
+    touch = d2 < (r[i] + r[j])**2
+    i, j = i[touch], j[touch]
+    rank = np.argsort(d2[touch] / (r[i] + r[j])**2, kind='stable')
+    return i[rank], j[rank]
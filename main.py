@@ -1,10 +1,15 @@
 import numpy as np
+import time
 from galaxy import Galaxy
 import glfw
 import moderngl
-from kernel import update
+import backends
+from sim import Simulation
+import diagnostics
+import config
 
 N = 100000
+REPORT = 120    # frames per frame-time report
 
 # ================= SHADERS =================
 
@@ -52,8 +57,11 @@ def perspective(fovy, aspect, znear, zfar):
 # ================= MAIN =================
 
 def main():
+    backend = backends.select()
+    print(f"backend: {backend.name}")
+
     gx = Galaxy(N)
-    gx.rando()
+    gx.rando(config.SEED)
     # gx.big_bang()
     gx.add(3, (0,0,0), (0,0,0))
 
@@ -75,20 +83,25 @@ def main():
         fragment_shader=FRAGMENT_SHADER,
     )
 
-    data = np.zeros(
-        N,
-        dtype=[('pos','f4',3), ('mass','f4'), ('color','f4',3)]
-    )
-    data['pos'] = gx.pos
-    data['mass'] = gx.masses
-    data['color'] = (0.1,0.7,1)
-    # data['color'] = (1,1,0.7)
-    # data['color'][-1] = (1,1,1)
+    backend.warm_up(gx)     # forces for the first step's opening kick
+    sim = Simulation(gx, backend)
+
+    # one buffer per attribute: positions stream every frame from the
+    # latest snapshot, mass and colour only go up when they change
+    color = np.empty((gx.capacity,3), dtype=np.float32)
+    color[:] = (0.1,0.7,1)
+    # color[:] = (1,1,0.7)
+    # color[-1] = (1,1,1)
+    frame = sim.snapshot(np.empty_like(sim.latest))
+
+    vbo_pos = ctx.buffer(frame)
+    vbo_mass = ctx.buffer(sim.masses)
+    vbo_color = ctx.buffer(color)
+    uploaded = sim.revision
 
-    vbo = ctx.buffer(data.tobytes())
     vao = ctx.vertex_array(
         prog,
-        [(vbo, "3f 1f 3f", "in_pos", "in_mass", "in_color")]
+        [(vbo_pos, "3f", "in_pos"), (vbo_mass, "1f", "in_mass"), (vbo_color, "3f", "in_color")]
     )
 
     fbw, fbh = glfw.get_framebuffer_size(window)
@@ -100,29 +113,49 @@ def main():
     MVP = proj @ view
     prog["MVP"].write(MVP.tobytes())
 
-    running = False
-
     def key_callback(window, key, scancode, action, mods):
-        nonlocal running
         if key == glfw.KEY_SPACE and action == glfw.PRESS:
-            running = not running
+            sim.toggle()
 
     glfw.set_key_callback(window, key_callback)
+    sim.start()
+
+    timing = np.zeros(3)    # snapshot, upload, draw seconds since the last report
+    frames = 0
+    steps, t_report = 0, time.perf_counter()
 
+    # render at display rate whatever a step costs
     while not glfw.window_should_close(window):
         glfw.poll_events()
+        t0 = time.perf_counter()
 
-        if running:
-            update(gx)
+        sim.snapshot(frame, config.INTERPOLATE)
 
-        data['pos'] = gx.pos
-        data['mass'] = gx.masses
-        vbo.write(data.tobytes())
+        t1 = time.perf_counter()
+        if sim.revision != uploaded:
+            vbo_mass.write(sim.masses)
+            uploaded = sim.revision
+        vbo_pos.write(frame)
 
+        t2 = time.perf_counter()
         ctx.clear(0,0,0)
         vao.render(moderngl.POINTS)
         glfw.swap_buffers(window)
 
+        timing += (t1 - t0, t2 - t1, time.perf_counter() - t2)
+        frames += 1
+        if frames == REPORT:
+            snap, upload, draw = timing / frames * 1e3
+            rate = (sim.steps - steps) / (time.perf_counter() - t_report)
+            print(f"frame {snap+upload+draw:.2f} ms: snapshot {snap:.2f}  upload {upload:.2f}  "
+                  f"draw {draw:.2f}  | sim {rate:.1f} steps/s")
+            if diagnostics.every:
+                print(diagnostics.line())
+            timing[:] = 0
+            frames = 0
+            steps, t_report = sim.steps, time.perf_counter()
+
+    sim.stop()
 
     glfw.terminate()
 
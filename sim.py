@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+# ------------------------------
+# Background simulation: steps the galaxy on its own thread and publishes
+# finished states into a triple buffer, so the render loop never waits on
+# a step (NumPy / numba release the GIL for the heavy work)
+# ------------------------------
+class Simulation(threading.Thread):
+    def __init__(self, gx, backend):
+        super().__init__(daemon=True)
+        self.gx = gx
+        self.backend = backend
+        self.running = threading.Event()
+        self.stopped = False
+        self.error = None
+        self.lock = threading.Lock()
+
+        # prev / latest are what the renderer may read, free is written
+        # by the next step; all three in particle id order
+        pos = gx.by_id(gx.pos)
+        self.prev, self.latest, self.free = pos, pos.copy(), pos.copy()
+        now = time.perf_counter()
+        self.t_prev, self.t_latest = now, now
+        self.steps = 0
+        self.masses = gx.by_id(gx.masses)
+        self.revision = gx.revision
+
+
+    def run(self):
+        try:
+            while not self.stopped:
+                if not self.running.wait(0.05):
+                    continue
+                self.backend.update(self.gx)
+                self.publish()
+        except Exception as e:
+            self.error = e
+
+
+    def publish(self):
+        gx = self.gx
+        self.free[gx.ids] = gx.pos
+        masses = gx.by_id(gx.masses) if gx.revision != self.revision else None
+
+        with self.lock:
+            self.prev, self.latest, self.free = self.latest, self.free, self.prev
+            self.t_prev, self.t_latest = self.t_latest, time.perf_counter()
+            self.steps += 1
+            if masses is not None:
+                self.masses, self.revision = masses, gx.revision
+
+
+    def snapshot(self, out, interpolate=True):
+        # positions to draw into out: the latest state, or the last two
+        # blended so motion stays smooth between steps (one step behind)
+        if self.error is not None:
+            raise self.error
+
+        with self.lock:
+            if not interpolate or not self.running.is_set():
+                out[:] = self.latest
+                return out
+
+            span = self.t_latest - self.t_prev
+            f = min((time.perf_counter() - self.t_latest) / span, 1.0) if span > 0 else 1.0
+            out[:] = self.prev + f * (self.latest - self.prev)
+        return out
+
+
+    def toggle(self):
+        if self.running.is_set():
+            self.running.clear()
+        else:
+            self.running.set()
+
+
+    def stop(self):
+        self.stopped = True
+        self.join()
@@ -0,0 +1,317 @@
+import numpy as np
+import config
+
+G = config.G
+eps = config.eps
+BITS = config.BITS
+THETA = config.THETA
+LEAF = config.LEAF
+CHUNK = config.CHUNK
+ORDER = config.ORDER
+
+GROUPS = 2048   # leaf groups walked together per batch
+
+
+class Octree:
+    def __init__(self, codes, pos, mass, box_size, leaf=LEAF, order=ORDER):
+        # codes / pos / mass must already be in Morton order
+        self.N = len(codes)
+        self.pos = pos.astype(np.float64)
+        self.mass = mass.astype(np.float64)
+        self.box_size = box_size
+        self.order = order
+
+        self.build(codes, leaf)
+        self.moments()
+        if order >= 2:
+            self.quadrupoles()
+
+
+    # ------------------------------
+    # Topology: one pass per level over the sorted codes
+    # ------------------------------
+    def build(self, codes, leaf):
+        N = self.N
+        starts = [np.array([0])]
+        ends = [np.array([N])]
+        firsts = []
+        counts = []
+
+        for level in range(1, BITS+1):
+            s, e = starts[-1], ends[-1]
+            split = (e - s) > leaf
+            if not split.any():
+                break
+            ps, pe = s[split], e[split]
+
+            # particles covered by a node that gets subdivided
+            inside = np.cumsum(
+                np.bincount(ps, minlength=N+1) - np.bincount(pe, minlength=N+1)
+            )[:N] > 0
+
+            prefix = codes >> np.uint64(3*(BITS-level))
+            brk = np.ones(N, dtype=bool)
+            brk[1:] = prefix[1:] != prefix[:-1]
+            brk[ps] = True
+
+            cs = np.flatnonzero(brk & inside)
+            parent = np.searchsorted(ps, cs, side='right') - 1
+            ce = np.minimum(np.append(cs[1:], N), pe[parent])
+
+            first = np.full(len(s), -1)
+            first[split] = np.searchsorted(cs, ps)
+            cnt = np.zeros(len(s), dtype=np.int64)
+            cnt[split] = np.bincount(parent, minlength=len(ps))
+            firsts.append(first)
+            counts.append(cnt)
+
+            starts.append(cs)
+            ends.append(ce)
+
+        firsts.append(np.full(len(starts[-1]), -1))
+        counts.append(np.zeros(len(starts[-1]), dtype=np.int64))
+
+        sizes = [len(s) for s in starts]
+        offset = np.concatenate(([0], np.cumsum(sizes)))
+
+        self.levels = len(starts)
+        self.offset = offset
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.level = np.repeat(np.arange(self.levels), sizes)
+        self.size = self.box_size / 2.0**self.level
+        self.nchild = np.concatenate(counts)
+        self.child = np.concatenate([
+            np.where(f >= 0, f + offset[l+1], -1) for l, f in enumerate(firsts)
+        ])
+        self.leaves = np.flatnonzero(self.nchild == 0)
+        self.leaves = self.leaves[np.argsort(self.start[self.leaves])]
+
+
+    # ------------------------------
+    # Mass + COM, leaves first then parent by parent level
+    # ------------------------------
+    def moments(self):
+        n = len(self.start)
+        self.M = np.zeros(n)
+        mx = np.zeros((n, 3))
+
+        leaves = self.leaves
+        ls = self.start[leaves]
+        self.M[leaves] = np.add.reduceat(self.mass, ls)
+        mx[leaves] = np.add.reduceat(self.mass[:,None] * self.pos, ls)
+
+        for level in range(self.levels-2, -1, -1):
+            lo, hi = self.offset[level], self.offset[level+1]
+            ids = np.arange(lo, hi)
+            ids = ids[self.nchild[ids] > 0]
+            if len(ids) == 0:
+                continue
+            first = self.child[ids] - hi
+            self.M[ids] = np.add.reduceat(self.M[hi:self.offset[level+2]], first)
+            mx[ids] = np.add.reduceat(mx[hi:self.offset[level+2]], first)
+
+        self.com = np.divide(mx, self.M[:,None], out=np.zeros_like(mx), where=self.M[:,None] > 0)
+
+
+    # ------------------------------
+    # Second moments sum m w w^T about each COM (xx yy zz xy xz yz)
+    # ------------------------------
+    def quadrupoles(self):
+        self.Q = np.zeros((len(self.start), 6))
+
+        leaves = self.leaves
+        ls = self.start[leaves]
+        w = self.pos - np.repeat(self.com[leaves], self.end[leaves] - ls, axis=0)
+        self.Q[leaves] = np.add.reduceat(self.mass[:,None] * outer(w), ls)
+
+        for level in range(self.levels-2, -1, -1):
+            lo, hi = self.offset[level], self.offset[level+1]
+            ids = np.arange(lo, hi)
+            ids = ids[self.nchild[ids] > 0]
+            if len(ids) == 0:
+                continue
+            kids = np.arange(hi, self.offset[level+2])
+            parent = np.repeat(ids, self.nchild[ids])
+
+            # parallel axis shift to the parent COM
+            s = self.com[kids] - self.com[parent]
+            shifted = self.Q[kids] + self.M[kids,None] * outer(s)
+            self.Q[ids] = np.add.reduceat(shifted, self.child[ids] - hi)
+
+
+    # ------------------------------
+    # Group walk: every leaf bucket shares one interaction list
+    # ------------------------------
+    def walk(self, groups, theta):
+        lo = np.minimum.reduceat(self.pos, self.start[self.leaves])[groups]
+        hi = np.maximum.reduceat(self.pos, self.start[self.leaves])[groups]
+        gc = 0.5 * (lo + hi)
+        gh = 0.5 * (hi - lo)
+
+        g = np.arange(len(groups))
+        n = np.zeros(len(groups), dtype=np.int64)
+        far, near = [], []
+
+        while len(g):
+            d = np.maximum(np.abs(self.com[n] - gc[g]) - gh[g], 0.0)
+            d2 = (d*d).sum(axis=1)
+            ok = self.size[n]**2 < theta*theta * d2
+            far.append((g[ok], n[ok]))
+
+            keep = ~ok & (self.M[n] > 0)
+            g, n = g[keep], n[keep]
+
+            leaf = self.nchild[n] == 0
+            near.append((g[leaf], n[leaf]))
+            g, n = g[~leaf], n[~leaf]
+
+            cnt = self.nchild[n]
+            g = np.repeat(g, cnt)
+            n = np.repeat(self.child[n], cnt) + ramp(cnt)
+
+        far = tuple(np.concatenate(x) for x in zip(*far))
+        near = tuple(np.concatenate(x) for x in zip(*near))
+        return far, near
+
+
+    def accel(self, theta=THETA, active=None):
+        # active: mask (tree order) of the targets wanted, others may stay 0
+        acc = np.zeros((3, self.N))
+        leaves = self.leaves
+        self.xyz = np.ascontiguousarray(self.pos.T, dtype=np.float32)
+
+        ids = np.arange(len(leaves))
+        if active is not None:
+            ids = ids[np.add.reduceat(active, self.start[leaves]) > 0]
+
+        for c in range(0, len(ids), GROUPS):
+            groups = ids[c:c+GROUPS]
+            (fg, fn), (ng, nn) = self.walk(groups, theta)
+
+            gs = self.start[leaves[groups]]
+            gn = self.end[leaves[groups]] - gs
+
+            # far field: node monopoles (+ quadrupoles)
+            q = self.Q[fn] if self.order >= 2 else None
+            self.interact(acc, gs[fg], gn[fg], self.com[fn], self.M[fn], q)
+
+            # near field: every particle of the neighbouring leaves
+            cnt = self.end[nn] - self.start[nn]
+            j = np.repeat(self.start[nn], cnt) + ramp(cnt)
+            g = np.repeat(ng, cnt)
+            self.interact(acc, gs[g], gn[g], self.pos[j], self.mass[j])
+
+        return acc.T.astype(np.float32)
+
+
+    def interact(self, acc, ts, tn, src, m, Q=None):
+        # pair k applies source k to targets ts[k] .. ts[k]+tn[k]-1
+        sx, sy, sz = np.ascontiguousarray(src.T, dtype=np.float32)
+        x, y, z = self.xyz
+        m = m.astype(np.float32)
+        total = np.cumsum(tn)
+        cut = np.searchsorted(total, np.arange(CHUNK, total[-1] if len(total) else 0, CHUNK))
+
+        for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+            if a == b:
+                continue
+            cnt = tn[a:b]
+            t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+            k = np.repeat(np.arange(a, b), cnt)
+
+            dx = sx[k] - x[t]
+            dy = sy[k] - y[t]
+            dz = sz[k] - z[t]
+            r2 = dx*dx + dy*dy + dz*dz + eps*eps
+            w = G * m[k] / (np.sqrt(r2)*r2)
+
+            ax, ay, az = w*dx, w*dy, w*dz
+
+            if Q is not None:
+                # a += G [H'(2 Q d + tr(Q) d) + 2 H'' (d.Q.d) d]
+                # for H(r^2) = (r^2 + eps^2)^-3/2
+                qxx, qyy, qzz, qxy, qxz, qyz = (G * Q[k,c].astype(np.float32) for c in range(6))
+                qdx = qxx*dx + qxy*dy + qxz*dz
+                qdy = qxy*dx + qyy*dy + qyz*dz
+                qdz = qxz*dx + qyz*dy + qzz*dz
+                h1 = -1.5 / (r2*r2*np.sqrt(r2))
+                h2 = -2.5 / r2 * h1
+                radial = h1 * (qxx + qyy + qzz) + 2*h2 * (dx*qdx + dy*qdy + dz*qdz)
+                ax += radial*dx + 2*h1*qdx
+                ay += radial*dy + 2*h1*qdy
+                az += radial*dz + 2*h1*qdz
+
+            acc[0] += np.bincount(t, weights=ax, minlength=self.N)
+            acc[1] += np.bincount(t, weights=ay, minlength=self.N)
+            acc[2] += np.bincount(t, weights=az, minlength=self.N)
+
+
+
+    def potential(self, theta=THETA):
+        # potential at every particle (tree order), node monopoles (+
+        # quadrupoles) for the far field; each particle's own term is
+        # taken back out
+        phi = np.zeros(self.N)
+        leaves = self.leaves
+        self.xyz = np.ascontiguousarray(self.pos.T, dtype=np.float32)
+
+        for c in range(0, len(leaves), GROUPS):
+            groups = np.arange(c, min(c + GROUPS, len(leaves)))
+            (fg, fn), (ng, nn) = self.walk(groups, theta)
+
+            gs = self.start[leaves[groups]]
+            gn = self.end[leaves[groups]] - gs
+            q = self.Q[fn] if self.order >= 2 else None
+            self.pair_potential(phi, gs[fg], gn[fg], self.com[fn], self.M[fn], q)
+
+            cnt = self.end[nn] - self.start[nn]
+            j = np.repeat(self.start[nn], cnt) + ramp(cnt)
+            g = np.repeat(ng, cnt)
+            self.pair_potential(phi, gs[g], gn[g], self.pos[j], self.mass[j])
+
+        return phi + G * self.mass / eps
+
+
+    def pair_potential(self, phi, ts, tn, src, m, Q=None):
+        # as interact, summing -G m / sqrt(r^2 + eps^2) instead of the force
+        sx, sy, sz = np.ascontiguousarray(src.T, dtype=np.float32)
+        x, y, z = self.xyz
+        m = m.astype(np.float32)
+        total = np.cumsum(tn)
+        cut = np.searchsorted(total, np.arange(CHUNK, total[-1] if len(total) else 0, CHUNK))
+
+        for a, b in zip(np.concatenate(([0], cut)), np.concatenate((cut, [len(tn)]))):
+            if a == b:
+                continue
+            cnt = tn[a:b]
+            t = np.repeat(ts[a:b], cnt) + ramp(cnt)
+            k = np.repeat(np.arange(a, b), cnt)
+
+            dx = sx[k] - x[t]
+            dy = sy[k] - y[t]
+            dz = sz[k] - z[t]
+            r2 = dx*dx + dy*dy + dz*dz + eps*eps
+            p = -G * m[k] / np.sqrt(r2)
+
+            if Q is not None:
+                # + G [H' tr(Q) + 2 H'' d.Q.d] for H(r^2) = -(r^2 + eps^2)^-1/2
+                qxx, qyy, qzz, qxy, qxz, qyz = (G * Q[k,c].astype(np.float32) for c in range(6))
+                dqd = (qxx*dx*dx + qyy*dy*dy + qzz*dz*dz
+                       + 2*(qxy*dx*dy + qxz*dx*dz + qyz*dy*dz))
+                h1 = 0.5 / (r2*np.sqrt(r2))
+                h2 = -1.5 / r2 * h1
+                p += h1 * (qxx + qyy + qzz) + 2*h2 * dqd
+
+            phi += np.bincount(t, weights=p, minlength=self.N)
+
+
+
+def outer(w):
+    x, y, z = w[:,0], w[:,1], w[:,2]
+    return np.stack([x*x, y*y, z*z, x*y, x*z, y*z], axis=1)
+
+
+def ramp(cnt):
+    # 0..cnt[0]-1, 0..cnt[1]-1, ...
+    return np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)